@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+async_value_db.py: asyncio interface to the ValueDB
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+import asyncio
+
+from value_db import sample_timestamp, rain_differences, AGG_AVG
+
+class AsyncValueDB:
+    # Awaitable wrapper around a ValueDB. Reads are handed to the reader
+    # threads and their concurrent.futures.Future is awaited, so one event
+    # loop can wait for many reads at once without a thread per reader.
+    def __init__(self, vdb):
+        self.vdb = vdb
+
+    async def stop(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.vdb.stop)
+
+    async def get_setting(self, key):
+        return await asyncio.wrap_future(self.vdb.get_setting_future(key))
+
+    def set_setting(self, key, value):
+        # only queues the write, never blocks
+        self.vdb.set_setting(key, value)
+
+    async def get_data(self, num, time_resolution, field, table, identifier = None, is_rain = False, agg = AGG_AVG):
+        return await asyncio.wrap_future(self.vdb.get_data_future(num, time_resolution, field, table, identifier, is_rain, agg))
+
+    async def get_data_air_quality(self, num, time_resolution, field):
+        return await self.get_data(num, time_resolution, field, 'air_quality')
+
+    async def get_data_station(self, num, time_resolution, field, identifier):
+        return await self.get_data(num, time_resolution, field, 'station', identifier)
+
+    async def get_data_sensor(self, num, time_resolution, field, identifier):
+        return await self.get_data(num, time_resolution, field, 'sensor', identifier)
+
+    async def get_data_rain_period_list(self, num, rain_period, identifier):
+        return rain_differences(await self.get_data(num+1, rain_period, 'rain', 'station', identifier, True))
+
+    async def get_data_rain_period(self, identifier, rain_period):
+        return await asyncio.wrap_future(self.vdb.get_data_rain_period_future(identifier, rain_period))
+
+    async def add_data(self, table, identifier, values, timestamp = None):
+        # Usually the sample goes into the ingest queue right away. Only if
+        # the queue is full and the table uses the block policy we wait for
+        # space in an executor thread, the event loop keeps running.
+        if timestamp == None:
+            timestamp = sample_timestamp()
+
+        if not self.vdb.add_data(table, identifier, values, timestamp, False):
+            await asyncio.get_event_loop().run_in_executor(None, self.vdb.add_data, table, identifier, values, timestamp)
+
+    async def add_data_air_quality(self, iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure, timestamp = None):
+        await self.add_data('air_quality', None, (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure), timestamp)
+
+    async def add_data_pm_concentration(self, pm10, pm25, pm100, timestamp = None):
+        await self.add_data('pm_concentration', None, (pm10, pm25, pm100), timestamp)
+
+    async def add_data_pm_count(self, greater03um, greater05um, greater10um, greater25um, greater50um, greater100um, timestamp = None):
+        await self.add_data('pm_count', None, (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um), timestamp)
+
+    async def add_data_co2(self, co2_concentration, temperature, humidity, timestamp = None):
+        await self.add_data('co2', None, (co2_concentration, temperature, humidity), timestamp)
+
+    async def add_data_station(self, identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low, timestamp = None):
+        await self.add_data('station', identifier, (temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low), timestamp)
+
+    async def add_data_sensor(self, identifier, temperature, humidity, timestamp = None):
+        await self.add_data('sensor', identifier, (temperature, humidity), timestamp)
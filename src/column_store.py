@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+column_store.py: Append-only column files as time series storage
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+import os
+import mmap
+import math
+import time
+import bisect
+import shutil
+import threading
+import contextlib
+import collections
+from array import array
+
+# Every series (table, resolution suffix and identifier) is split into
+# segments that cover this many seconds. A segment is one file per column:
+#
+#   <path>/<table><suffix>/<identifier>/<segment start>.<column>
+#
+# The time column stores the offset to the segment start (in ms for raw
+# samples, in seconds for the rollups), the value columns are plain fixed
+# width integers, so a time range is found by bisecting the time column and
+# the values are a slice of the same rows in every column. A missing value
+# is stored as the smallest integer of its type. Rollup columns are 32 bit,
+# only the columns that hold the sum of a bucket (wide columns) are 64 bit.
+#
+# Rows that are older than the last row of their segment (backfill) start a
+# new run of the segment (<segment start>_<run>.<column>), so the time
+# column of every run stays sorted. A segment with more than COMPACT_RUNS
+# runs is merged into a single new run.
+SEGMENT_SECONDS = {'': 60*60*24, '_minute': 60*60*24*30, '_hour': 60*60*24*365, '_day': 60*60*24*3650}
+TIME_SCALE      = {'': 1000, '_minute': 1, '_hour': 1, '_day': 1}
+
+TIME_TYPECODE        = 'I'
+RAW_TYPECODE         = 'i'
+ROLLUP_TYPECODE      = 'i'
+ROLLUP_WIDE_TYPECODE = 'q'
+MISSING              = {'i': -2**31, 'q': -2**63}
+
+# The format of a store is kept in this file. Stores without it are of
+# version 1: all rollup columns 64 bit and missing values stored as 0.
+STORE_VERSION      = 2
+STORE_VERSION_FILE = 'version'
+
+COMPACT_RUNS = 8
+
+class SharedLock:
+    # Readers share it, compacting a segment needs it alone. Appending to
+    # a run doesn't take it, readers only use rows that are complete.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers   = 0
+        self.writer    = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.writer = True
+            try:
+                self.condition.wait_for(lambda: self.readers == 0)
+                yield
+            finally:
+                self.writer = False
+                self.condition.notify_all()
+
+class ColumnStore:
+    def __init__(self, path, wide_columns = ()):
+        self.path     = path
+        self.wide     = set(wide_columns)
+        self.files    = {} # column files opened for appending (writer only)
+        self.repaired = set()
+        self.tails    = {} # (series path, segment) -> (run, last time offset)
+        self.lock     = SharedLock()
+
+        self.version = STORE_VERSION
+        version_file = os.path.join(path, STORE_VERSION_FILE)
+        if os.path.exists(version_file):
+            with open(version_file) as f:
+                self.version = int(f.read().strip())
+        elif os.path.isdir(path) and any(os.path.isdir(os.path.join(path, name)) for name in os.listdir(path)):
+            self.version = 1
+
+    def series_path(self, table, suffix, identifier):
+        if identifier == None:
+            identifier = 'all'
+        return os.path.join(self.path, table + suffix, str(identifier))
+
+    def identifiers(self, table, suffix):
+        # Identifiers of all series of a table, the series without one is None
+        table_path = os.path.join(self.path, table + suffix)
+        if not os.path.isdir(table_path):
+            return []
+
+        return [None if name == 'all' else int(name) for name in os.listdir(table_path)]
+
+    def segments(self, series_path):
+        # Sorted list of (segment start, run)
+        try:
+            names = os.listdir(series_path)
+        except OSError:
+            return []
+
+        ret = set()
+        compacted = {}
+        for name in names:
+            if name.endswith('.time'):
+                parts = name[:-len('.time')].split('_')
+                ret.add((int(parts[0]), int(parts[1]) if len(parts) > 1 else 0))
+
+        for name in names:
+            if name.endswith('.compacted') and name[:-len('.compacted')] + '.time' in names:
+                parts = name[:-len('.compacted')].split('_')
+                compacted[int(parts[0])] = max(int(parts[1]), compacted.get(int(parts[0]), 0))
+
+        # runs that were merged into a compacted run but not deleted yet
+        return sorted((segment, run) for segment, run in ret if run >= compacted.get(segment, 0))
+
+    def run_base(self, series_path, segment, run):
+        if run == 0:
+            return os.path.join(series_path, str(segment))
+        return os.path.join(series_path, '{0}_{1}'.format(segment, run))
+
+    def typecode(self, suffix, column):
+        if column == 'time':
+            return TIME_TYPECODE
+        if suffix == '':
+            return RAW_TYPECODE
+        if self.version < 2 or column in self.wide:
+            return ROLLUP_WIDE_TYPECODE
+        return ROLLUP_TYPECODE
+
+    def missing(self, typecode):
+        # the time column is never missing
+        if self.version < 2:
+            return 0
+        return MISSING.get(typecode, 0)
+
+    def length(self, filename, typecode):
+        try:
+            return os.path.getsize(filename)//array(typecode).itemsize
+        except OSError:
+            return 0
+
+    def run_length(self, base, suffix, columns):
+        return min(self.length(base + '.' + column, self.typecode(suffix, column)) for column in ['time'] + columns)
+
+    def read_column(self, filename, typecode, lo, hi):
+        if hi <= lo:
+            return []
+
+        with open(filename, 'rb') as f:
+            m = mmap.mmap(f.fileno(), hi*array(typecode).itemsize, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(m).cast(typecode)
+                ret = view[lo:hi].tolist()
+                view.release()
+            finally:
+                m.close()
+
+        missing = MISSING.get(typecode)
+        if self.version >= 2 and missing in ret:
+            ret = [None if value == missing else value for value in ret]
+
+        return ret
+
+    def time_range(self, filename, length, lo_offset, hi_offset = None):
+        # Rows lo:hi of a run with lo_offset <= time offset < hi_offset and
+        # their time offsets. The mapped column is bisected in place, only the
+        # rows in the range are copied.
+        if length == 0:
+            return 0, 0, []
+
+        with open(filename, 'rb') as f:
+            m = mmap.mmap(f.fileno(), length*array(TIME_TYPECODE).itemsize, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(m).cast(TIME_TYPECODE)
+                lo = bisect.bisect_left(view, lo_offset)
+                hi = length if hi_offset == None else bisect.bisect_left(view, hi_offset)
+                ret = view[lo:hi].tolist() if hi > lo else []
+                view.release()
+            finally:
+                m.close()
+
+        return lo, hi, ret
+
+    def append(self, table, suffix, identifier, columns, rows):
+        # rows are lists of [time, value, ...] in the order of columns
+        series_path = self.series_path(table, suffix, identifier)
+        seconds = SEGMENT_SECONDS[suffix]
+        scale = TIME_SCALE[suffix]
+
+        segments = {}
+        for row in rows:
+            segment = int(row[0]) - int(row[0]) % seconds
+            segments.setdefault(segment, []).append(row)
+
+        for segment, segment_rows in sorted(segments.items()):
+            segment_rows.sort(key=lambda row: row[0])
+            offsets = [int(round((row[0] - segment)*scale)) for row in segment_rows]
+
+            run, last = self.tail(series_path, segment, suffix, columns)
+            backfill = last != None and offsets[0] < last
+            if backfill:
+                run, last = run + 1, None
+
+            base = self.run_base(series_path, segment, run)
+            self.repair(base, suffix, columns)
+
+            # The time column is written last, readers only use rows that
+            # are complete in all columns
+            for i, column in reversed(list(enumerate(['time'] + columns))):
+                typecode = self.typecode(suffix, column)
+                if column == 'time':
+                    values = offsets
+                else:
+                    values = [self.missing(typecode) if row[i] == None else int(round(row[i])) for row in segment_rows]
+
+                self.file(base + '.' + column).write(array(typecode, values).tobytes())
+
+            self.tails[(series_path, segment)] = (run, offsets[-1])
+
+            if backfill:
+                runs = [start_run for start, start_run in self.segments(series_path) if start == segment]
+                if len(runs) > COMPACT_RUNS:
+                    self.compact(series_path, segment, suffix, columns, runs)
+
+    def compact(self, series_path, segment, suffix, columns, runs):
+        # Merge the runs of a segment into one run after the last one, so
+        # backfill doesn't leave more and more runs that every read of the
+        # segment has to go through. The merged run is marked as compacted
+        # before its time column appears, from then on readers skip the
+        # runs before it (also if we crash before they are deleted).
+        self.flush() # the runs are read from the files
+
+        times  = []
+        values = [[] for column in columns]
+        for run in runs:
+            base = self.run_base(series_path, segment, run)
+            length = self.run_length(base, suffix, columns)
+            times.extend(self.read_column(base + '.time', TIME_TYPECODE, 0, length))
+            for i, column in enumerate(columns):
+                values[i].extend(self.read_column(base + '.' + column, self.typecode(suffix, column), 0, length))
+
+        order = sorted(range(len(times)), key=times.__getitem__)
+        run = runs[-1] + 1
+        base = self.run_base(series_path, segment, run)
+
+        for i, column in enumerate(columns):
+            typecode = self.typecode(suffix, column)
+            missing = self.missing(typecode)
+            with open(base + '.' + column, 'wb') as f:
+                f.write(array(typecode, [missing if values[i][j] == None else values[i][j] for j in order]).tobytes())
+
+        with open(base + '.time.tmp', 'wb') as f:
+            f.write(array(TIME_TYPECODE, [times[j] for j in order]).tobytes())
+        open(base + '.compacted', 'w').close()
+        os.rename(base + '.time.tmp', base + '.time')
+
+        # readers that listed the old runs before are done with them first
+        with self.lock.exclusive():
+            for name in os.listdir(series_path):
+                parts = name.split('.')[0].split('_')
+                if int(parts[0]) == segment and (int(parts[1]) if len(parts) > 1 else 0) < run:
+                    f = self.files.pop(os.path.join(series_path, name), None)
+                    if f != None:
+                        f.close()
+                    os.remove(os.path.join(series_path, name))
+
+        os.remove(base + '.compacted')
+
+        self.repaired = set(old for old in self.repaired if os.path.dirname(old) != series_path or
+                            os.path.basename(old).split('_')[0] != str(segment))
+        self.repaired.add(base)
+        self.tails[(series_path, segment)] = (run, times[order[-1]] if len(order) > 0 else None)
+
+    def tail(self, series_path, segment, suffix, columns):
+        # Last run of a segment and the time offset of its last row
+        key = (series_path, segment)
+        if key not in self.tails:
+            runs = [run for start, run in self.segments(series_path) if start == segment]
+            if len(runs) == 0:
+                self.tails[key] = (0, None)
+            else:
+                base = self.run_base(series_path, segment, runs[-1])
+                self.repair(base, suffix, columns)
+                length = self.run_length(base, suffix, columns)
+                last = self.read_column(base + '.time', TIME_TYPECODE, length - 1, length)
+                self.tails[key] = (runs[-1], last[0] if len(last) > 0 else None)
+
+        return self.tails[key]
+
+    def repair(self, base, suffix, columns):
+        # After a crash the columns of a segment might have different lengths,
+        # cut them to the last complete row before appending to them again
+        if base in self.repaired:
+            return
+
+        if not os.path.isdir(os.path.dirname(base)):
+            os.makedirs(os.path.dirname(base))
+
+        if os.path.exists(base + '.compacted') and not os.path.exists(base + '.time'):
+            # left by a compaction that didn't finish
+            os.remove(base + '.compacted')
+
+        version_file = os.path.join(self.path, STORE_VERSION_FILE)
+        if not os.path.exists(version_file):
+            with open(version_file, 'w') as f:
+                f.write(str(self.version))
+
+        length = self.run_length(base, suffix, columns)
+        for column in ['time'] + columns:
+            filename = base + '.' + column
+            typecode = self.typecode(suffix, column)
+            if os.path.exists(filename):
+                with open(filename, 'r+b') as f:
+                    f.truncate(length*array(typecode).itemsize)
+            else:
+                # columns that are new in this segment have no values yet
+                with open(filename, 'wb') as f:
+                    f.write(array(typecode, [self.missing(typecode)]*length).tobytes())
+
+        self.repaired.add(base)
+
+    def file(self, filename):
+        f = self.files.get(filename)
+        if f == None:
+            f = open(filename, 'ab')
+            self.files[filename] = f
+        return f
+
+    def flush(self):
+        # Like sqlite with synchronous = NORMAL we hand the data to the OS
+        # but don't fsync on every commit
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def read(self, table, suffix, identifier, columns, start, end = None, limit = None):
+        # Returns [time, value, ...] rows with start <= time < end
+        times, values = self.read_columns(table, suffix, identifier, columns, start, end, limit)
+        return [[t] + [value[i] for value in values] for i, t in enumerate(times)]
+
+    def read_columns(self, table, suffix, identifier, columns, start, end = None, limit = None):
+        # Returns the times and one list per column for start <= time < end
+        # in time order, this only copies the slices out of the mapped files
+        # a compaction waits until the runs are read
+        with self.lock.shared():
+            series_path = self.series_path(table, suffix, identifier)
+            seconds = SEGMENT_SECONDS[suffix]
+            scale = TIME_SCALE[suffix]
+
+            runs = collections.OrderedDict()
+            for segment, run in self.segments(series_path):
+                if segment + seconds <= start or (end != None and segment >= end):
+                    continue
+                runs.setdefault(segment, []).append(run)
+
+            times  = []
+            values = [[] for column in columns]
+            for segment, segment_runs in runs.items():
+                segment_times  = []
+                segment_values = [[] for column in columns]
+
+                for run in segment_runs:
+                    base = self.run_base(series_path, segment, run)
+                    length = self.run_length(base, suffix, columns)
+                    lo, hi, run_times = self.time_range(base + '.time', length, int(math.ceil(max(0, start - segment)*scale)),
+                                                        None if end == None else int(math.ceil((end - segment)*scale)))
+
+                    if hi <= lo:
+                        continue
+
+                    segment_times.extend(run_times)
+                    for i, column in enumerate(columns):
+                        segment_values[i].extend(self.read_column(base + '.' + column, self.typecode(suffix, column), lo, hi))
+
+                if len(segment_runs) > 1:
+                    order = sorted(range(len(segment_times)), key=segment_times.__getitem__)
+                    segment_times = [segment_times[i] for i in order]
+                    segment_values = [[value[i] for i in order] for value in segment_values]
+
+                if limit != None:
+                    segment_times = segment_times[:limit - len(times)]
+
+                if scale == 1:
+                    times.extend(segment + t for t in segment_times)
+                else:
+                    times.extend(segment + float(t)/scale for t in segment_times)
+
+                for i in range(len(columns)):
+                    values[i].extend(segment_values[i][:len(segment_times)])
+
+                if limit != None and len(times) >= limit:
+                    break
+
+            return times, values
+
+    def last(self, table, suffix, identifier, columns):
+        # Newest row of a series, the last row of every run is its newest
+        with self.lock.shared():
+            series_path = self.series_path(table, suffix, identifier)
+            scale = TIME_SCALE[suffix]
+
+            segments = self.segments(series_path)
+            for segment in sorted(set(segment for segment, run in segments), reverse=True):
+                ret = None
+                for run in [run for start, run in segments if start == segment]:
+                    base = self.run_base(series_path, segment, run)
+                    length = self.run_length(base, suffix, columns)
+                    if length == 0:
+                        continue
+
+                    t = segment + float(self.read_column(base + '.time', TIME_TYPECODE, length - 1, length)[0])/scale
+                    if ret == None or t >= ret[0]:
+                        ret = [t] + [self.read_column(base + '.' + column, self.typecode(suffix, column), length - 1, length)[0] for column in columns]
+
+                if ret != None:
+                    return ret
+
+            return None
+
+    def drop(self, table, suffix, identifier):
+        series_path = self.series_path(table, suffix, identifier)
+        for filename in list(self.files):
+            if os.path.dirname(filename) == series_path:
+                self.files.pop(filename).close()
+
+        self.repaired = set(base for base in self.repaired if os.path.dirname(base) != series_path)
+        self.tails = dict((key, tail) for key, tail in self.tails.items() if key[0] != series_path)
+        shutil.rmtree(series_path, True)
+
+    def prune(self, table, suffix, horizon):
+        # Retention works on whole segments, returns the number of deleted files
+        deleted = 0
+        seconds = SEGMENT_SECONDS[suffix]
+        oldest = time.time() - horizon
+        table_path = os.path.join(self.path, table + suffix)
+
+        for identifier in os.listdir(table_path) if os.path.isdir(table_path) else []:
+            series_path = os.path.join(table_path, identifier)
+            for segment, run in self.segments(series_path):
+                if segment + seconds > oldest:
+                    break
+
+                base = self.run_base(series_path, segment, run)
+                for filename in [os.path.join(series_path, name) for name in os.listdir(series_path)]:
+                    if filename.startswith(base + '.'):
+                        f = self.files.pop(filename, None)
+                        if f != None:
+                            f.close()
+                        os.remove(filename)
+                        deleted += 1
+
+                self.repaired.discard(base)
+                self.tails.pop((series_path, segment), None)
+
+        return deleted
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+downsample.py: Pick one representative value per graph column
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+# The line graph of the LCD has one value per pixel column. The average of
+# a column hides short events, the min/max envelope keeps them, but only
+# one of the two can be drawn.
+#
+# A column shows its min or max instead of its average if that extreme
+# stands out from the columns around it: the SPIKE_COLUMNS columns on
+# either side and the column itself. Their median average is the baseline
+# and their median spread (max - min) is the noise, the extreme that is
+# furthest from the baseline is taken if it is further away than the
+# noise. A spike (up or down) of up to SPIKE_COLUMNS columns moves neither
+# median, so every column of it keeps its extreme, while a noisy but flat
+# stretch stays on its averages instead of jumping between min and max.
+# (The name comes from Largest-Triangle-Three-Buckets, which picks the
+# candidate furthest from its neighbours as well, but turns noise into a
+# sawtooth.)
+
+SPIKE_COLUMNS = 3
+
+def median(values):
+    values = sorted(values)
+    middle = len(values)//2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle])/2.0
+
+def lttb(averages, minimums, maximums):
+    columns = []
+    for average, minimum, maximum in zip(averages, minimums, maximums):
+        if minimum == None or maximum == None:
+            columns.append(None)
+        else:
+            columns.append((minimum + maximum)/2.0 if average == None else average)
+
+    ret = []
+    for i, average in enumerate(averages):
+        if columns[i] == None:
+            ret.append(average)
+            continue
+
+        around = [j for j in range(max(0, i - SPIKE_COLUMNS), min(len(columns), i + SPIKE_COLUMNS + 1)) if columns[j] != None]
+        baseline = median([columns[j] for j in around])
+        noise = median([maximums[j] - minimums[j] for j in around])
+
+        if abs(maximums[i] - baseline) >= abs(minimums[i] - baseline):
+            extreme = maximums[i]
+        else:
+            extreme = minimums[i]
+
+        ret.append(extreme if abs(extreme - baseline) > noise else columns[i])
+
+    return ret
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+graph_data.py: Slot averages and LCD scaling of the graph windows
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+# Every graph is refreshed once per second: the per slot sums and counts of
+# the window are turned into averages, empty slots are marked and the values
+# are scaled to 0-255 for the LCD. With NumPy each step is one vectorized
+# operation on arrays that are allocated once per window and reused, empty
+# slots are NaN. Otherwise the same is done with plain lists, both paths
+# return the same values.
+#
+# Converting the lists from and to arrays costs more than NumPy saves on a
+# graph of the LCD (87 slots), see graph_data_benchmark.py. NumPy is only
+# used for windows of at least NUMPY_MIN_SLOTS slots.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_MIN_SLOTS = 1000
+
+class GraphBuffer:
+    # Not thread safe, every user keeps its own buffer. vectorized = None
+    # uses NumPy if it is available and the window is large enough.
+    def __init__(self, num, vectorized = None):
+        self.num        = num
+        self.requested  = vectorized
+        if vectorized == None:
+            vectorized = numpy != None and num >= NUMPY_MIN_SLOTS
+        self.vectorized = vectorized
+
+        if vectorized:
+            self.values = numpy.empty(num)
+            self.counts = numpy.empty(num)
+            self.valid  = numpy.empty(num, bool)
+
+    def resize(self, num):
+        if num != self.num:
+            self.__init__(num, self.requested)
+
+    def averages(self, sums, counts):
+        # sums may contain None for empty slots, empty slots are None
+        num = len(counts)
+        self.resize(num)
+
+        if not self.vectorized:
+            ret = []
+            for value, count in zip(sums, counts):
+                if value == None or count == 0:
+                    ret.append(None)
+                else:
+                    ret.append(float(value)/count)
+
+            return ret
+
+        values = self.values
+        values[:] = numpy.array(sums, float) # None becomes NaN
+        self.counts[:] = counts
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            numpy.divide(values, self.counts, out=values)
+        numpy.equal(self.counts, 0, out=self.valid)
+        values[self.valid] = numpy.nan
+        numpy.isfinite(values, out=self.valid)
+
+        return [value if valid else None for value, valid in zip(values.tolist(), self.valid.tolist())]
+
+    def scale(self, data):
+        # Returns the values scaled to 0-255 and the min and max they are
+        # scaled between. None entries are ignored and stay None, without any
+        # other entry min and max are None.
+        if not data:
+            return [0], 0, 0
+
+        self.resize(len(data))
+
+        if not self.vectorized:
+            present = [d for d in data if d != None]
+            if not present:
+                return [None]*len(data), None, None
+
+            value_min = min(present)
+            value_max = max(present)
+            if value_max-value_min == 0:
+                return [None if d == None else 127 for d in data], value_min, value_max
+
+            ret = []
+            for d in data:
+                ret.append(None if d == None else int((d-value_min)*255/(value_max-value_min)))
+            return ret, value_min, value_max
+
+        values = self.values
+        values[:] = numpy.array(data, float)
+        numpy.isfinite(values, out=self.valid)
+        if not self.valid.any():
+            return [None]*len(data), None, None
+
+        present = values[self.valid]
+        value_min = present.min().item()
+        value_max = present.max().item()
+        if value_max-value_min == 0:
+            values[:] = 127
+        else:
+            numpy.subtract(values, value_min, out=values)
+            numpy.multiply(values, 255, out=values)
+            numpy.divide(values, value_max-value_min, out=values)
+
+        if self.valid.all():
+            return values.astype(int).tolist(), value_min, value_max
+
+        values[~self.valid] = 0
+        return [int(value) if valid else None for value, valid in zip(values.tolist(), self.valid.tolist())], value_min, value_max
+
+def fill_gaps(values):
+    # Slots without data repeat the value of the previous slot (leading empty
+    # slots take the first value), no data at all results in zeros
+    first = next((value for value in values if value != None), 0)
+
+    ret = []
+    for value in values:
+        if value == None:
+            value = ret[-1] if ret else first
+        ret.append(value)
+
+    return ret
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+graph_data_benchmark.py: Compares the NumPy and the plain Python graph path
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+# Times one graph refresh (slot averages and scaling to 0-255)
+# for both paths and checks that they return the same values. Run it on the
+# station itself, the result depends a lot on the CPU and NumPy version:
+#
+#   graph_data_benchmark.py --num 87 --gaps 0.1
+#
+# On a x86_64 server with Python 3.11 and NumPy 2.4 the plain path took about
+# 37 us and NumPy about 55 us for 87 slots, they only broke even between 500
+# and 1000 slots (NUMPY_MIN_SLOTS in graph_data.py).
+
+import sys
+import random
+import timeit
+import platform
+import argparse
+import collections
+
+import graph_data
+from graph_data import GraphBuffer
+
+def window(num, gaps):
+    sums = collections.deque(maxlen=num)
+    counts = collections.deque(maxlen=num)
+    for i in range(num):
+        if random.random() < gaps:
+            sums.append(None)
+            counts.append(0)
+        else:
+            count = random.randint(1, 60)
+            sums.append(sum(random.randint(2000, 2500) for _ in range(count)))
+            counts.append(count)
+
+    return sums, counts
+
+def refresh(buf, sums, counts):
+    return buf.scale(buf.averages(sums, counts))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the graph refresh with and without NumPy')
+    parser.add_argument('--num', type=int, default=87, help='slots per graph (default: %(default)s)')
+    parser.add_argument('--gaps', type=float, default=0.1, help='share of empty slots (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='best of this many runs (default: %(default)s)')
+    args = parser.parse_args()
+
+    print('{0} {1}, Python {2}'.format(platform.machine(), platform.processor() or platform.platform(), platform.python_version()))
+
+    sums, counts = window(args.num, args.gaps)
+
+    paths = [('python', GraphBuffer(args.num, False))]
+    if graph_data.numpy != None:
+        print('NumPy {0}'.format(graph_data.numpy.__version__))
+        paths.append(('numpy', GraphBuffer(args.num, True)))
+    else:
+        print('NumPy not available, only the plain Python path is timed')
+
+    results = []
+    for name, buf in paths:
+        timer = timeit.Timer(lambda: refresh(buf, sums, counts))
+        loops, _ = timer.autorange()
+        best = min(timer.repeat(args.repeat, loops))/loops
+        results.append(refresh(buf, sums, counts))
+        print('{0:>6}: {1:8.1f} us per refresh of {2} slots'.format(name, best*1e6, args.num))
+
+    if len(results) > 1 and results[0] != results[1]:
+        print('Paths differ')
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
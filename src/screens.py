@@ -25,11 +25,27 @@ Boston, MA 02111-1307, USA.
 import icons
 import logging as log
 
+from graph_data import GraphBuffer, fill_gaps
+
 
 TIME_SHORTCUTS = ['1s', '2s', '5s', '10s', '30s', '1m', '2m', '5m', '10m', '30m', '1h', '2h', '4h', '8h', '12h', '1d', '10d', '1M']
 TIME_STRINGS   = ['1 second', '2 seconds', '5 seconds', '10 seconds', '30 seconds', '1 minute', '2 minutes', '5 minutes', '10 minutes', '30 minutes', '1 hour', '2 hours', '4 hours', '8 hours', '12 hours', '1 day', '10 days', '1 month']
 TIME_SECONDS   = [1, 2, 5, 10, 30, 1*60, 2*60, 5*60, 10*60, 30*60, 1*60*60, 2*60*60, 4*60*60, 8*60*60, 12*60*60, 1*60*60*24, 10*60*60*24, 30*60*60*24]
 
+# What a graph pixel shows (agg of ValueDB.get_data), selected per graph with
+# a left/right swipe. 'lttb' keeps the peaks of the min/max envelope. The
+# shortcut is appended to the time of the x axis caption (4 characters max).
+GRAPH_MODES          = ['avg', 'lttb', 'max', 'min']
+GRAPH_MODE_SHORTCUTS = ['', '*', '^', 'v']
+
+# Position and size of the graph, the values are drawn at the left of it
+GRAPH_X      = 40
+GRAPH_WIDTH  = 87
+GRAPH_HEIGHT = 52
+
+# Rows at the bottom of the graph that are hatched below slots without data
+GRAPH_GAP_ROWS = 4
+
 class Screen:
     WIDTH  = 128
     HEIGHT = 64
@@ -40,6 +56,9 @@ class Screen:
     tws    = None
     vdb    = None
 
+    graph_buffer = None
+    graph_gaps   = None # columns hatched in the user layer, None: nothing drawn
+
     def draw_init(self):
         pass
 
@@ -55,19 +74,56 @@ class Screen:
     def draw_icon(self, x, y, icon):
         Screen.lcd.write_pixels(x, y, x + icon.WIDTH-1, y + icon.HEIGHT-1, icon.data)
 
+    def get_graph_mode(self, table, field):
+        mode = self.vdb.get_setting('graph_mode_{0}_{1}'.format(table, field))
+        if mode not in GRAPH_MODES:
+            return GRAPH_MODES[0]
+        return mode
+
+    def cycle_graph_mode(self, table, field, step):
+        index = (GRAPH_MODES.index(self.get_graph_mode(table, field)) + step) % len(GRAPH_MODES)
+        self.vdb.set_setting('graph_mode_{0}_{1}'.format(table, field), GRAPH_MODES[index])
+
+    def graph_x_caption(self, table, field):
+        caption = TIME_SHORTCUTS[self.tws.graph_resolution_index]
+        if table == 'station' and field == 'rain':
+            return caption
+        return caption + GRAPH_MODE_SHORTCUTS[GRAPH_MODES.index(self.get_graph_mode(table, field))]
+
     def scale_data_for_graph(self, data):
-        if not data:
-            return [0], 0, 0
+        # the buffer is reused for every refresh of this screen
+        if self.graph_buffer == None:
+            self.graph_buffer = GraphBuffer(len(data))
+
+        return self.graph_buffer.scale(data)
+
+    def draw_graph(self, data, fmt, divisor):
+        # Slots without data are None. The graph can't leave a column out,
+        # there the line keeps the previous value and the bottom of the column
+        # is hatched in the user layer below the graph (the graph stays on top
+        # of it). Only the columns that changed since the last refresh are
+        # written. Min and max are taken from the slots with data only.
+        scaled_data, value_min, value_max = self.scale_data_for_graph(data)
+
+        value_min = '-' if value_min == None else fmt.format(float(value_min)/divisor)
+        value_max = '-' if value_max == None else fmt.format(float(value_max)/divisor)
+        value_min = ' '*(6 - len(value_min)) + value_min
+        value_max = ' '*(6 - len(value_max)) + value_max
+        self.lcd.draw_text(2, 0,  self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_max)
+        self.lcd.draw_text(2, 45, self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_min)
 
-        ret = []
-        value_min = min(data)
-        value_max = max(data)
-        if value_max-value_min == 0:
-            return [127]*len(data), value_min, value_max
+        gaps = [x < len(scaled_data) and scaled_data[x] == None for x in range(GRAPH_WIDTH)]
+        drawn = self.graph_gaps or [False]*GRAPH_WIDTH
+        changed = [x for x in range(GRAPH_WIDTH) if gaps[x] != drawn[x]]
+        if len(changed) > 0:
+            pixels = []
+            for y in range(GRAPH_HEIGHT - GRAPH_GAP_ROWS, GRAPH_HEIGHT):
+                for x in range(changed[0], changed[-1] + 1):
+                    pixels.append(gaps[x] and (x + y) % 2 == 0)
+            self.lcd.write_pixels(GRAPH_X + changed[0], GRAPH_HEIGHT - GRAPH_GAP_ROWS, GRAPH_X + changed[-1], GRAPH_HEIGHT - 1, pixels)
+            self.graph_gaps = gaps
 
-        for d in data:
-            ret.append(int((d-value_min)*255/(value_max-value_min)))
-        return ret, value_min, value_max
+        self.lcd.set_gui_graph_data(0, fill_gaps(scaled_data))
 
 class IndoorScreen(Screen):
     text = "Data"
@@ -207,9 +263,10 @@ class GraphScreen(Screen):
             self.lcd.draw_line(15+offset, 11 + 19 + 10, 20+offset, 16 + 19, self.num != 0)
 
         num_graphs = self.get_num_graphs()
-        caption, _, _, _, _, _, num_icon = self.get_value_properties()
+        caption, _, _, field, table, _, num_icon = self.get_value_properties()
 
-        self.lcd.set_gui_graph_configuration(0, self.lcd.GRAPH_TYPE_LINE, 40, 0, 87, 52, TIME_SHORTCUTS[self.tws.graph_resolution_index], caption)
+        self.graph_gaps = None # the display was cleared
+        self.lcd.set_gui_graph_configuration(0, self.lcd.GRAPH_TYPE_LINE, GRAPH_X, 0, GRAPH_WIDTH, GRAPH_HEIGHT, self.graph_x_caption(table, field), caption)
 
         if num_icon != None:
             # air quality graph
@@ -232,19 +289,11 @@ class GraphScreen(Screen):
         # Rain data needs special handling since we need to calculate mm/period while the database has
         # sum of mm over all measurements
         if table == 'station' and field == 'rain':
-            data = self.vdb.get_data_rain_period_list(87, TIME_SECONDS[self.tws.graph_resolution_index], identifier)
+            data = self.vdb.get_data_rain_period_list(GRAPH_WIDTH, TIME_SECONDS[self.tws.graph_resolution_index], identifier)
         else:
-            data = self.vdb.get_data(87, TIME_SECONDS[self.tws.graph_resolution_index], field, table, identifier)
+            data = self.vdb.get_data(GRAPH_WIDTH, TIME_SECONDS[self.tws.graph_resolution_index], field, table, identifier, agg=self.get_graph_mode(table, field))
 
-        scaled_data, value_min, value_max = self.scale_data_for_graph(data)
-
-        value_min = fmt.format(float(value_min)/divisor)
-        value_max = fmt.format(float(value_max)/divisor)
-        value_min = ' '*(6 - len(value_min)) + value_min
-        value_max = ' '*(6 - len(value_max)) + value_max
-        self.lcd.draw_text(2, 0,  self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_max)
-        self.lcd.draw_text(2, 45, self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_min)
-        self.lcd.set_gui_graph_data(0, scaled_data)
+        self.draw_graph(data, fmt, divisor)
 
     def touch_gesture(self, gesture, duration, pressure_max, x_start, x_end, y_start, y_end, age):
         num_graphs = self.get_num_graphs()
@@ -259,6 +308,12 @@ class GraphScreen(Screen):
                 self.num -= 1
                 self.lcd.clear_display()
                 self.draw_init()
+        elif gesture in (self.lcd.GESTURE_LEFT_TO_RIGHT, self.lcd.GESTURE_RIGHT_TO_LEFT):
+            _, _, _, field, table, _, _ = self.get_value_properties()
+            if not (table == 'station' and field == 'rain'):
+                self.cycle_graph_mode(table, field, 1 if gesture == self.lcd.GESTURE_RIGHT_TO_LEFT else -1)
+                self.lcd.clear_display()
+                self.draw_init()
 
 
 
@@ -293,9 +348,10 @@ class CustomGraphScreen(Screen):
                 self.lcd.draw_line(15+offset, 11 + 19 + 10, 20+offset, 16 + 19, self.num != 0)
 
             num_graphs = self.get_num_graphs()
-            caption, _, _, _, _, _, num_icon = self.get_value_properties()
+            caption, _, _, field, table, _, num_icon = self.get_value_properties()
 
-            self.lcd.set_gui_graph_configuration(0, self.lcd.GRAPH_TYPE_LINE, 40, 0, 87, 52, TIME_SHORTCUTS[self.tws.graph_resolution_index], caption)
+            self.graph_gaps = None # the display was cleared
+            self.lcd.set_gui_graph_configuration(0, self.lcd.GRAPH_TYPE_LINE, GRAPH_X, 0, GRAPH_WIDTH, GRAPH_HEIGHT, self.graph_x_caption(table, field), caption)
 
             if num_icon != None:
                 # air quality graph
@@ -320,30 +376,30 @@ class CustomGraphScreen(Screen):
             # Rain data needs special handling since we need to calculate mm/period while the database has
             # sum of mm over all measurements
             if table == 'station' and field == 'rain':
-                data = self.vdb.get_data_rain_period_list(87, TIME_SECONDS[self.tws.graph_resolution_index], identifier)
+                data = self.vdb.get_data_rain_period_list(GRAPH_WIDTH, TIME_SECONDS[self.tws.graph_resolution_index], identifier)
             else:
-                data = self.vdb.get_data(87, TIME_SECONDS[self.tws.graph_resolution_index], field, table, identifier)
+                data = self.vdb.get_data(GRAPH_WIDTH, TIME_SECONDS[self.tws.graph_resolution_index], field, table, identifier, agg=self.get_graph_mode(table, field))
 
-
-            scaled_data, value_min, value_max = self.scale_data_for_graph(data)
-
-            value_min = fmt.format(float(value_min)/divisor)
-            value_max = fmt.format(float(value_max)/divisor)
-            value_min = ' '*(6 - len(value_min)) + value_min
-            value_max = ' '*(6 - len(value_max)) + value_max
-            self.lcd.draw_text(2, 0,  self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_max)
-            self.lcd.draw_text(2, 45, self.lcd.FONT_6X8, self.lcd.COLOR_BLACK, value_min)
-            self.lcd.set_gui_graph_data(0, scaled_data)
+            self.draw_graph(data, fmt, divisor)
         else:
+            # Issue all queries first, so they can run concurrently
+            futures = []
+            for field in self.fields:
+                futures.append(self.vdb.get_data_future(1, TIME_SECONDS[self.tws.graph_resolution_index], field, self.table, None))
+
             row = 1
             for ind in range(len(self.captions)):
                 caption = self.captions[ind]
                 field = self.fields[ind]
                 divisor = self.divisors[ind]
                 format = self.formats[ind]
-                data = self.vdb.get_data(1, TIME_SECONDS[self.tws.graph_resolution_index], field, self.table, None)
+                data = futures[ind].result()
 
-                self.lcd.write_line(row, 3, field[:5] + ": " + str(format.format(data[0]/divisor)) + caption )
+                # no sample in the current period yet
+                if data[0] == None:
+                    self.lcd.write_line(row, 3, field[:5] + ": -" + caption)
+                else:
+                    self.lcd.write_line(row, 3, field[:5] + ": " + str(format.format(data[0]/divisor)) + caption )
                 row += 1
                 
 
@@ -14,7 +14,8 @@ from tinkerforge.bricklet_air_quality import BrickletAirQuality, GetAllValues
 from tinkerforge.bricklet_particulate_matter import BrickletParticulateMatter
 from tinkerforge.bricklet_co2_v2 import BrickletCO2V2, GetAllValues as GAV_CO2
 from screens import screen_set_lcd, screen_tab_selected, screen_touch_gesture, screen_update, screen_slider_value, Screen, TIME_SECONDS
-from value_db import ValueDB
+from value_db import ValueDB, sample_timestamp
+from value_db_server import Forwarder
 from datetime import datetime
 
 import queue
@@ -150,9 +151,10 @@ class WeatherStation:
     def cb_air_quality_all_values(self, iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure):
         self.air_quality_last_value = GetAllValues(iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
 
-        now = time.time()
+        timestamp = sample_timestamp()
+        now = timestamp.wall
         if now - self.last_air_quality_time >= TIME_SECONDS[self.logging_period_index]:
-            self.vdb.add_data_air_quality(iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
+            self.vdb.add_data_air_quality(iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure, timestamp=timestamp)
             self.last_air_quality_time = now
             
             # sheet = client.open('TinkerForge_DataCollector').worksheet('AirQuality')
@@ -164,9 +166,10 @@ class WeatherStation:
     def cb_pm_concentration(self, pm10, pm25, pm100):
         self.pm_last_value = (pm10, pm25, pm100)
 
-        now = time.time()
+        timestamp = sample_timestamp()
+        now = timestamp.wall
         if now - self.last_pm_concentration_time >= TIME_SECONDS[self.logging_period_index] and self.pm.get_enable():
-            self.vdb.add_data_pm_concentration(pm10,pm25,pm100)
+            self.vdb.add_data_pm_concentration(pm10,pm25,pm100, timestamp=timestamp)
             self.last_pm_concentration_time = now
         
 
@@ -184,9 +187,10 @@ class WeatherStation:
     def cb_pm_count(self, greater03um, greater05um, greater10um, greater25um, greater50um, greater100um):
         self.pm_count_last_value = (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
 
-        now = time.time()
+        timestamp = sample_timestamp()
+        now = timestamp.wall
         if now - self.last_pm_count_time >= TIME_SECONDS[self.logging_period_index] and self.pm.get_enable():
-            self.vdb.add_data_pm_count(greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
+            self.vdb.add_data_pm_count(greater03um, greater05um, greater10um, greater25um, greater50um, greater100um, timestamp=timestamp)
             self.last_pm_count_time = now
 
         # turn of and turn on again for specific time, to increase lifetime of the sensor
@@ -203,9 +207,10 @@ class WeatherStation:
     def cb_co2_values(self, co2_concentration, temperature, humidity):
         self.co2_last_value = GAV_CO2(co2_concentration, temperature, humidity)
 
-        now = time.time()
+        timestamp = sample_timestamp()
+        now = timestamp.wall
         if now - self.last_co2_time >= TIME_SECONDS[self.logging_period_index]:
-            self.vdb.add_data_co2(co2_concentration, temperature, humidity)
+            self.vdb.add_data_co2(co2_concentration, temperature, humidity, timestamp=timestamp)
             self.last_co2_time = now
 
 
@@ -306,7 +311,39 @@ def loop(run_ref, stop_queue):
     packaged = False
 
     save_to_google_spreadsheet = None #60*60*8
-    vdb = ValueDB(gui, packaged, save_to_google_spreadsheet=save_to_google_spreadsheet)
+
+    # Delete raw samples / minute rollups older than this many seconds
+    # (None keeps everything). Keep at least one hour of raw samples for
+    # the rain period and two days of minute rollups for the graphs.
+    retention_raw = None #60*60*24*7
+    retention_minute = None #60*60*24*90
+
+    # 'columnar' stores samples and rollups in compact column files instead
+    # of sqlite tables (settings stay in sqlite)
+    backend = 'sqlite'
+
+    # At most this many samples wait for the database, per table what to do
+    # when the queue is full: 'block', 'drop_oldest' or 'coalesce'
+    ingest_queue_size = 1000
+    ingest_policy = {'air_quality': 'coalesce', 'pm_concentration': 'coalesce', 'pm_count': 'coalesce', 'co2': 'coalesce'}
+
+    # Also send all samples to a central value_db_server.py, e.g.
+    # ('192.168.0.10', 4290), the graphs are still drawn from the local database
+    forward_to = None
+    station_id = socket.gethostname().split('.')[0]
+
+    # Keep every graph that was shown up to date for all resolutions of the
+    # graph resolution slider, so changing it doesn't query the database
+    # (None: only the shown resolution is kept, for a minute after use)
+    pyramid = TIME_SECONDS
+
+    forward = None
+    if forward_to != None:
+        forward = Forwarder(forward_to, station_id)
+
+    vdb = ValueDB(gui, packaged, save_to_google_spreadsheet=save_to_google_spreadsheet,
+                  retention_raw=retention_raw, retention_minute=retention_minute, backend=backend,
+                  ingest_queue_size=ingest_queue_size, ingest_policy=ingest_policy, forward=forward, pyramid=pyramid)
     tws = WeatherStation(vdb)
     Screen.tws = tws
     Screen.vdb = vdb
@@ -29,21 +29,861 @@ import time
 import datetime
 import logging as log
 import sys
+import collections
+import shutil
+import bisect
+import math
+from concurrent.futures import Future
+
+from column_store import ColumnStore
+from graph_data import GraphBuffer
+import downsample
 
 try:
     import Queue as queue
 except:
     import queue
 
+try:
+    from urllib import pathname2url
+except:
+    from urllib.request import pathname2url
+
+ROLLUP_RESOLUTIONS = [('_minute', 60), ('_hour', 60*60), ('_day', 60*60*24)]
+
+# How a column is aggregated over a bucket of the rollup tables
+SUM  = 'sum'
+MIN  = 'min'
+MAX  = 'max'
+LAST = 'last'
+P95  = 'p95' # streaming estimate, see QuantileSketch
+
+# Every averaged (SUM) column gets these extra rollup columns, named
+# <column>_min, <column>_max and <column>_p95
+ROLLUP_STATS      = [MIN, MAX, P95]
+ROLLUP_PERCENTILE = 95
+
+# The P95 of a bucket is exact up to this many samples, see QuantileSketch
+QUANTILE_EXACT_SAMPLES = 200
+
+# What get_data returns per slot: the average, one of ROLLUP_STATS or the
+# min or max of the slot picked by downsample.lttb (keeps short spikes)
+AGG_AVG  = 'avg'
+AGG_MIN  = MIN
+AGG_MAX  = MAX
+AGG_P95  = P95
+AGG_LTTB = 'lttb'
+AGGS     = [AGG_AVG, AGG_MIN, AGG_MAX, AGG_P95, AGG_LTTB]
+
+# Retention: rows deleted per step, seconds between steps while there are
+# old rows left, seconds between pruning rounds and pages freed per round
+RETENTION_BATCH_SIZE     = 500
+RETENTION_BATCH_INTERVAL = 1
+RETENTION_INTERVAL       = 10*60
+RETENTION_VACUUM_PAGES   = 1000
+
+# What add_data does when the ingest queue is full (per table): wait for
+# the DB thread, drop the oldest queued sample of the table or merge the
+# sample into the newest queued one of the same sensor
+QUEUE_BLOCK       = 'block'
+QUEUE_DROP_OLDEST = 'drop_oldest'
+QUEUE_COALESCE    = 'coalesce'
+
+# Seconds without further changes after which settings are written
+SETTINGS_WRITE_DELAY = 2
+
+# Graph cache entries that were not read for this many seconds are dropped
+# (except for the pyramid resolutions, see pyramid_fill)
+GRAPH_CACHE_TIMEOUT = 60
+
+# stop() waits for the DB thread to write everything that is queued, it
+# logs a warning every this many seconds while it is still busy
+STOP_WARNING_INTERVAL = 10
+
+# Storage backends for the samples and rollups, settings are always kept
+# in sqlite
+BACKEND_SQLITE   = 'sqlite'
+BACKEND_COLUMNAR = 'columnar'
+
+# With the columnar backend the open rollup buckets are appended to the
+# column files every this many seconds (and when they close), in between
+# readers see them through an in-memory snapshot
+ROLLUP_CHECKPOINT_INTERVAL = 10*60
+
+# With the columnar backend this many of the last written buckets are kept
+# in memory, so backfill that goes back and forth between buckets doesn't
+# read them from the column files every time
+ROLLUP_RECENT_BUCKETS = 1000
+
+# With the sqlite backend closed buckets of these rollups are mirrored into
+# column files, so the long graph resolutions are read without SQL
+ROLLUP_MIRROR_SUFFIXES = ['_hour', '_day']
+ROLLUP_MIRROR_CLEAN    = 'clean' # marker file, written on shutdown
+ROLLUP_MIRROR_VERSION  = 3       # content of the marker, a mirror of another version is rebuilt
+
+# Time of a sample: wall clock for storage and monotonic clock for
+# measuring how long it took until it was stored (None for backfill)
+Timestamp = collections.namedtuple('Timestamp', ['wall', 'monotonic'])
+
+def sample_timestamp():
+    return Timestamp(time.time(), time.monotonic())
+
+def window_start(num, time_resolution, now = None):
+    # Graph windows are aligned to multiples of the time resolution and the
+    # last of the num slots is the one that contains the current time
+    if now == None:
+        now = time.time()
+    now = int(now)
+    return now - now % time_resolution - (num - 1)*time_resolution
+
+def percentile_slots(num, samples):
+    # Sums and counts for get_data from the sorted samples per slot, the
+    # ROLLUP_PERCENTILE of a slot is its nearest rank value
+    sums   = [None]*num
+    counts = [0]*num
+    for slot, values in samples.items():
+        if 0 <= slot < num and len(values) > 0:
+            sums[slot]   = values[int(math.ceil(len(values)*ROLLUP_PERCENTILE/100.0)) - 1]
+            counts[slot] = 1
+
+    return sums, counts
+
+def rain_differences(values):
+    # The rain counter per slot turned into the rain per slot: the difference
+    # to the last slot with data before it, slots without data are None
+    rain_values = []
+    last = values[0]
+    for value in values[1:]:
+        rain_values.append(None if value == None or last == None else value - last)
+        if value != None:
+            last = value
+
+    return rain_values
+
+class Request:
+    # A call that is executed by the DB thread or by one of the reader
+    # threads. Every caller waits on its own future, so results can't get
+    # mixed up between callers and several requests can be in flight.
+    def __init__(self, func, data, future = None):
+        self.func   = func
+        self.data   = data
+        self.future = future
+
+    def run(self):
+        if self.future == None:
+            try:
+                self.func(*self.data)
+            except:
+                log.exception('Error during database request')
+            return
+
+        if not self.future.set_running_or_notify_cancel():
+            return
+
+        try:
+            self.future.set_result(self.func(*self.data))
+        except Exception as e:
+            self.future.set_exception(e)
+
+    def cancel(self):
+        # Pending callers get None, like for a missing value
+        if self.future != None and self.future.set_running_or_notify_cancel():
+            self.future.set_result(None)
+
+class SampleRequest(Request):
+    # add_data call in the ingest queue, several samples can be merged into
+    # one while it waits: columns aggregated with SUM are averaged, MAX
+    # columns keep the maximum and all others the newest value
+    def __init__(self, func, table, identifier, values, timestamp):
+        Request.__init__(self, func, (table, identifier, values, timestamp))
+        self.table      = table
+        self.identifier = identifier
+        self.sums       = list(values)
+        self.count      = 1
+
+    def merge(self, values, kinds):
+        for i, kind in enumerate(kinds):
+            if values[i] == None:
+                continue
+            if self.sums[i] == None or kind not in (SUM, MAX):
+                self.sums[i] = values[i]
+            elif kind == MAX:
+                self.sums[i] = max(self.sums[i], values[i])
+            else:
+                self.sums[i] += values[i]
+
+        self.count += 1
+
+        # the merged sample keeps the time of the first one
+        averaged = []
+        for value, kind in zip(self.sums, kinds):
+            if kind == SUM and value != None:
+                value = int(round(float(value)/self.count))
+            averaged.append(value)
+        self.data = (self.table, self.identifier, tuple(averaged), self.data[3])
+
+class IngestQueue:
+    # Queue of the DB thread. Only samples count towards maxsize (0: no
+    # limit), settings and the stop request always fit into the queue.
+    def __init__(self, maxsize):
+        self.maxsize   = maxsize
+        self.items     = collections.deque()
+        self.samples   = 0
+        self.closed    = False
+        self.condition = threading.Condition()
+        self.dropped   = collections.Counter()
+        self.coalesced = collections.Counter()
+
+    def put(self, request):
+        with self.condition:
+            self.items.append(request)
+            self.condition.notify_all()
+
+    def put_sample(self, request, policy, kinds, block = True):
+        # Returns False if the sample was not queued because the queue is
+        # full and block is False (only with QUEUE_BLOCK)
+        with self.condition:
+            while not self.closed and self.maxsize > 0 and self.samples >= self.maxsize:
+                if policy == QUEUE_BLOCK:
+                    if not block:
+                        return False
+                    self.condition.wait()
+                    continue
+
+                if policy == QUEUE_COALESCE and self.coalesce(request, kinds):
+                    return True
+                if policy == QUEUE_DROP_OLDEST and self.drop_oldest(request.table):
+                    break
+
+                # nothing of this sensor in the queue, the other policies
+                # never block the callback, so the new sample is dropped
+                self.dropped[request.table] += 1
+                return True
+
+            if self.closed:
+                return True
+
+            self.items.append(request)
+            self.samples += 1
+            self.condition.notify_all()
+            return True
+
+    def coalesce(self, request, kinds):
+        for queued in reversed(self.items):
+            if isinstance(queued, SampleRequest) and queued.table == request.table and queued.identifier == request.identifier:
+                queued.merge(request.data[2], kinds)
+                self.coalesced[request.table] += 1
+                return True
+        return False
+
+    def drop_oldest(self, table):
+        for queued in self.items:
+            if isinstance(queued, SampleRequest) and queued.table == table:
+                self.items.remove(queued)
+                self.samples -= 1
+                self.dropped[table] += 1
+                return True
+        return False
+
+    def get(self, block = True, timeout = None):
+        with self.condition:
+            if block:
+                if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                    raise queue.Empty
+            elif len(self.items) == 0:
+                raise queue.Empty
+
+            request = self.items.popleft()
+            if isinstance(request, SampleRequest):
+                self.samples -= 1
+                self.condition.notify_all()
+
+            return request
+
+    def close(self):
+        # samples added after the DB thread ended are ignored
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'queued': self.samples, 'dropped': dict(self.dropped), 'coalesced': dict(self.coalesced)}
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max    = max(self.max, value)
+
+    def get(self):
+        if self.count == 0:
+            return {'count': 0, 'average': None, 'max': None}
+        return {'count': self.count, 'average': self.total/self.count, 'max': self.max}
+
+class GraphCacheEntry:
+    # Ring buffer with the per slot sums and counts of one get_data window.
+    # It is filled once from the database and then kept up to date with
+    # every new sample, so reading a graph doesn't need any SQL. For min/max
+    # (and rain) the slot holds the extreme with a count of 1. A percentile
+    # can't be updated with single samples, those entries are dropped on
+    # new samples instead (see graph_cache_add).
+    def __init__(self, num, time_resolution, field, is_rain, start, sums, counts, agg = AGG_AVG):
+        self.num             = num
+        self.time_resolution = time_resolution
+        self.field           = field
+        self.is_rain         = is_rain
+        self.agg             = agg
+        self.start           = start
+        self.sums            = collections.deque(sums, num)
+        self.counts          = collections.deque(counts, num)
+        self.buffer          = GraphBuffer(num)
+        self.last_access     = time.time()
+
+    def advance(self, now):
+        start = window_start(self.num, self.time_resolution, now)
+        shift = (start - self.start)//self.time_resolution
+        if shift <= 0:
+            return
+
+        for i in range(min(shift, self.num)):
+            self.sums.append(None)
+            self.counts.append(0)
+
+        self.start = start
+
+    def add(self, sample_time, value):
+        # Only the wall clock moves the window, a sample with a time after
+        # the current slot (given by the caller) is left out
+        self.advance(time.time())
+
+        slot = (int(sample_time) - self.start)//self.time_resolution
+        if slot < 0 or slot >= self.num or value == None:
+            return
+
+        if self.sums[slot] == None:
+            self.sums[slot] = value
+        elif self.is_rain or self.agg == AGG_MAX:
+            self.sums[slot] = max(self.sums[slot], value)
+        elif self.agg == AGG_MIN:
+            self.sums[slot] = min(self.sums[slot], value)
+        else:
+            self.sums[slot] += value
+
+        if self.is_rain or self.agg in (AGG_MIN, AGG_MAX):
+            self.counts[slot] = 1
+        else:
+            self.counts[slot] += 1
+
+    def get(self, now):
+        self.advance(now)
+        self.last_access = now
+
+        return self.buffer.averages(self.sums, self.counts)
+
+class RainWindow:
+    # Rain counter values of one station over the last rain_period seconds in
+    # time order. It is filled once from the database and then kept up to
+    # date with every new sample like a GraphCacheEntry, so the rain of the
+    # period is the difference between the first and the last value without
+    # any SQL.
+    def __init__(self, rain_period, rows):
+        self.rain_period = rain_period
+        self.rows        = sorted(rows) # (time, rain)
+        self.last_access = time.time()
+
+    def prune(self, now):
+        del self.rows[:bisect.bisect_right(self.rows, (now - self.rain_period, float('inf')))]
+
+    def add(self, sample_time, rain):
+        if rain == None:
+            return
+
+        # backfilled samples can come in out of order
+        bisect.insort(self.rows, (sample_time, rain))
+        self.prune(time.time())
+
+    def get(self, now):
+        self.prune(now)
+        self.last_access = now
+
+        if len(self.rows) == 0:
+            return None
+
+        return max(0, self.rows[-1][1] - self.rows[0][1])
+
+class TableSchema:
+    # Describes a sensor table and generates all statements needed for it.
+    # columns is a list of (name, aggregation) with the aggregation used for
+    # the _minute, _hour and _day tables (None: only stored in raw table).
+    # SUM columns get the ROLLUP_STATS columns in the rollup tables as well.
+    def __init__(self, name, identifier, columns):
+        rollup = [(column, kind, column) for column, kind in columns if kind != None]
+        for column, kind in columns:
+            if kind == SUM:
+                rollup += [('{0}_{1}'.format(column, stat), stat, column) for stat in ROLLUP_STATS]
+
+        self.name           = name
+        self.identifier     = identifier
+        self.columns        = [column for column, _ in columns]
+        self.rollup_columns = [column for column, _, _ in rollup]
+        self.rollup_kinds   = [kind for _, kind, _ in rollup]
+        self.rollup_sources = [source for _, _, source in rollup] # raw column a rollup column is computed from
+        self.kinds          = [kind for _, kind in columns]
+
+        key_columns = ['time']
+        key_where   = 'time = ?'
+        if identifier:
+            key_columns.append('identifier')
+            key_where += ' AND identifier = ?'
+
+        self.insert_sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            name, ', '.join(key_columns + self.columns), ', '.join(['?']*(len(key_columns) + len(self.columns))))
+
+        # statements for the rollup tables, the table name is filled in per resolution
+        rollup_columns = self.rollup_columns + ['count']
+        self.rollup_select_sql = 'SELECT {0} FROM {{0}} WHERE {1}'.format(', '.join(rollup_columns), key_where)
+        self.rollup_insert_sql = 'INSERT INTO {{0}} ({0}) VALUES ({1})'.format(
+            ', '.join(key_columns + rollup_columns), ', '.join(['?']*(len(key_columns) + len(rollup_columns))))
+        self.rollup_update_sql = 'UPDATE {{0}} SET {0} WHERE {1}'.format(
+            ', '.join('{0} = ?'.format(column) for column in rollup_columns), key_where)
+
+    def key(self, bucket_time, identifier):
+        if self.identifier:
+            return [bucket_time, identifier]
+        return [bucket_time]
+
+    def rollup_column(self, field, agg):
+        # Rollup column with agg of field, None if there is none
+        if agg == AGG_AVG:
+            return field
+
+        column = '{0}_{1}'.format(field, agg)
+        if column not in self.rollup_columns:
+            return None
+        return column
+
+    def rollup_fill(self, row):
+        # Buckets that were written before the stat columns existed have NULL
+        # there, they get the average of the bucket instead
+        row = list(row)
+        count = row[-1]
+        for i, (column, source) in enumerate(zip(self.rollup_columns, self.rollup_sources)):
+            if row[i] == None and column != source:
+                total = row[self.rollup_columns.index(source)]
+                row[i] = 0 if total == None or not count else int(round(float(total)/count))
+
+        return row
+
+    def create_sql(self):
+        columns = ['{0} integer'.format(column) for column in self.columns]
+        rollup_columns = ['{0} integer'.format(column) for column in self.rollup_columns] + ['count integer default 1']
+        if self.identifier:
+            columns = ['identifier integer'] + columns
+            rollup_columns = ['identifier integer'] + rollup_columns + ['UNIQUE(time, identifier)']
+            unique = ''
+        else:
+            unique = ' unique'
+
+        ret = ['CREATE TABLE IF NOT EXISTS {0} (id integer primary key, time timestamp default (strftime(\'%s\', \'now\')), {1})'.format(self.name, ', '.join(columns))]
+        for suffix, seconds in ROLLUP_RESOLUTIONS:
+            ret.append('CREATE TABLE IF NOT EXISTS {0}{1} (id integer primary key, time timestamp{2} default (strftime(\'%s\', \'now\') - (strftime(\'%s\', \'now\')%{3})), {4})'.format(
+                self.name, suffix, unique, seconds, ', '.join(rollup_columns)))
+        ret.append('CREATE INDEX IF NOT EXISTS {0}_time ON {0} (time)'.format(self.name))
+        if self.identifier:
+            # the rain period and the graphs select one sensor by time
+            ret.append('CREATE INDEX IF NOT EXISTS {0}_identifier_time ON {0} (identifier, time)'.format(self.name))
+
+        return ret
+
+    def rollup_rebuild_sql(self, suffix, seconds):
+        # Statements that recompute the buckets of one resolution from the raw
+        # rows with start <= time < end (?1 and ?2) in a single pass (raw times
+        # have sub-second precision, they are cut to seconds first). The LAST
+        # columns take their value from the newest raw row of the bucket, the
+        # P95 columns get the exact percentile (nearest rank) of the bucket.
+        bucket = 'CAST(time AS INTEGER) - CAST(time AS INTEGER) % {0}'.format(seconds)
+        group = ['bucket']
+        key_columns = ['time']
+        last_where = 'r.time >= b.bucket AND r.time < b.bucket + {0}'.format(seconds)
+        if self.identifier:
+            group.append('identifier')
+            key_columns.append('identifier')
+            last_where += ' AND r.identifier = b.identifier'
+
+        inner = []
+        outer = []
+        joins = []
+        for column, kind, source in zip(self.rollup_columns, self.rollup_kinds, self.rollup_sources):
+            if kind == LAST:
+                outer.append('(SELECT r.{0} FROM {1} r WHERE {2} ORDER BY r.time DESC, r.id DESC LIMIT 1)'.format(source, self.name, last_where))
+                continue
+            elif kind == P95:
+                alias = 'p{0}'.format(len(joins))
+                partition = bucket + (', identifier' if self.identifier else '')
+                joins.append(' LEFT JOIN (SELECT {0}, value FROM (SELECT {1} AS bucket, {2}{3} AS value, ROW_NUMBER() OVER (PARTITION BY {4} ORDER BY {3}) AS rank, '
+                             'COUNT(*) OVER (PARTITION BY {4}) AS n FROM {5} WHERE time >= ?1 AND time < ?2) WHERE rank = (n*{6} + 99)/100) {7} ON {8}'.format(
+                                 ', '.join(group), bucket, 'identifier, ' if self.identifier else '', source, partition, self.name, ROLLUP_PERCENTILE, alias,
+                                 ' AND '.join('{0}.{1} = b.{1}'.format(alias, key) for key in group)))
+                outer.append('{0}.value'.format(alias))
+                continue
+
+            inner.append('{0}({1}) AS {2}'.format(kind.upper(), source, column))
+            outer.append('b.' + column)
+
+        delete_sql = 'DELETE FROM {0}{1} WHERE time >= ? AND time < ?'.format(self.name, suffix)
+        insert_sql = 'INSERT INTO {0}{1} ({2}) SELECT {3} FROM (SELECT {4} AS bucket, {5} FROM {0} WHERE time >= ?1 AND time < ?2 GROUP BY {6}) b{7}'.format(
+            self.name, suffix, ', '.join(key_columns + self.rollup_columns + ['count']), ', '.join(['b.' + column for column in group] + outer + ['b.count']),
+            bucket, ', '.join(group[1:] + inner + ['COUNT(*) AS count']), ', '.join(group), ''.join(joins))
+
+        return delete_sql, insert_sql
+
+    def rollup_check_sql(self, suffix, seconds):
+        # Number of samples per bucket according to the raw table and
+        # according to the rollup table, both in the same order
+        key = 'bucket'
+        if self.identifier:
+            key += ', identifier'
+
+        raw_sql = 'SELECT CAST(time AS INTEGER) - CAST(time AS INTEGER) % {0} AS bucket, {1}, COUNT(*) FROM {2} WHERE time >= ? AND time < ? GROUP BY {3} ORDER BY {3}'.format(
+            seconds, 'identifier' if self.identifier else 'NULL', self.name, key)
+        rollup_sql = 'SELECT time AS bucket, {0}, count FROM {1}{2} WHERE time >= ? AND time < ? ORDER BY {3}'.format(
+            'identifier' if self.identifier else 'NULL', self.name, suffix, key)
+
+        return raw_sql, rollup_sql
+
+TABLES = collections.OrderedDict((schema.name, schema) for schema in [
+    TableSchema('air_quality', False, [('iaq_index', SUM), ('iaq_index_accuracy', SUM), ('temperature', SUM), ('humidity', SUM), ('air_pressure', SUM)]),
+    TableSchema('pm_concentration', False, [('pm10', SUM), ('pm25', SUM), ('pm100', SUM)]),
+    TableSchema('pm_count', False, [('greater03um', SUM), ('greater05um', SUM), ('greater10um', SUM), ('greater25um', SUM), ('greater50um', SUM), ('greater100um', SUM)]),
+    TableSchema('co2', False, [('co2_concentration', SUM), ('temperature', SUM), ('humidity', SUM)]),
+    TableSchema('station', True, [('temperature', SUM), ('humidity', SUM), ('wind_speed', SUM), ('gust_speed', MAX), ('rain', LAST), ('wind_direction', None), ('battery_low', None)]),
+    TableSchema('sensor', True, [('temperature', SUM), ('humidity', SUM)]),
+])
+
+# Rollup columns that hold the sum of a bucket, they need 64 bit in the
+# column files
+ROLLUP_WIDE_COLUMNS = set(column for schema in TABLES.values() for column, kind in zip(schema.rollup_columns, schema.rollup_kinds) if kind == SUM)
+
+# Tables whose day rollups are uploaded to Google Sheets, one per interval
+GS_WORKSHEETS = [('air_quality', 'AirQuality'), ('pm_concentration', 'PM_Concentration'), ('pm_count', 'PM_Count'), ('co2', 'CO2')]
+
+def check_get_data(table, field, is_rain, agg):
+    # table and field end up in SQL and in the names of column files, only
+    # the ones of the schema are allowed
+    if table not in TABLES:
+        raise ValueError('Unknown table: {0}'.format(table))
+    if field not in TABLES[table].columns:
+        raise ValueError('Unknown field of {0}: {1}'.format(table, field))
+    if agg not in AGGS:
+        raise ValueError('Unknown agg: {0}'.format(agg))
+    if is_rain and (table, field) != ('station', 'rain'):
+        raise ValueError('Only station.rain is a rain counter: {0}.{1}'.format(table, field))
+
+def create_tables(dbc):
+    for schema in TABLES.values():
+        for sql in schema.create_sql():
+            dbc.execute(sql)
+
+        # rollup tables of older versions don't have all stat columns yet
+        for suffix, seconds in ROLLUP_RESOLUTIONS:
+            dbc.execute('PRAGMA table_info({0}{1})'.format(schema.name, suffix))
+            existing = set(row[1] for row in dbc.fetchall())
+            for column in schema.rollup_columns:
+                if column not in existing:
+                    dbc.execute('ALTER TABLE {0}{1} ADD COLUMN {2} integer'.format(schema.name, suffix, column))
+
+    dbc.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            id integer primary key,
+            key text NOT NULL UNIQUE,
+            value text
+        )"""
+    )
+
+class QuantileSketch:
+    # Estimate of one quantile with constant memory. Up to
+    # QUANTILE_EXACT_SAMPLES samples are kept sorted and the result is exact,
+    # then five P-square markers (Jain and Chlamtac) at the minimum, p/2, p,
+    # (1+p)/2 and the maximum are placed on them and moved with every sample.
+    #
+    # A bucket that is continued after a restart only has its min, max and
+    # estimate, the sketch is resumed from those.
+    def __init__(self, p, count = 0, minimum = None, estimate = None, maximum = None):
+        self.p          = p
+        self.increments = [0, p/2, p, (1 + p)/2, 1]
+        self.samples    = [] # sorted, until the markers are placed
+        self.heights    = None
+
+        if count == 0 or estimate == None:
+            return
+
+        if count <= QUANTILE_EXACT_SAMPLES:
+            # the estimate stands for all samples except the extremes
+            self.samples = [estimate] if count == 1 else [minimum] + [estimate]*(count - 2) + [maximum]
+        else:
+            self.place([minimum, (minimum + estimate)/2.0, estimate, (estimate + maximum)/2.0, maximum], count)
+
+    def marker_positions(self, count):
+        desired = [1 + (count - 1)*increment for increment in self.increments]
+        positions = [1, 0, 0, 0, count]
+        for i in range(1, 4):
+            positions[i] = min(max(int(round(desired[i])), positions[i - 1] + 1), count - 4 + i)
+
+        return positions, desired
+
+    def place(self, heights, count):
+        self.heights = heights
+        self.positions, self.desired = self.marker_positions(count)
+
+    def add(self, value):
+        if self.heights == None:
+            bisect.insort(self.samples, value)
+            if len(self.samples) > QUANTILE_EXACT_SAMPLES:
+                positions, desired = self.marker_positions(len(self.samples))
+                self.place([self.samples[n - 1] for n in positions], len(self.samples))
+                self.samples = []
+            return
+
+        h = self.heights
+        n = self.positions
+
+        if value < h[0]:
+            h[0] = value
+            k = 0
+        elif value >= h[4]:
+            h[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(h, value) - 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+
+                # parabolic prediction, linear if it leaves the neighbours
+                q = h[i] + float(d)/(n[i + 1] - n[i - 1])*((n[i] - n[i - 1] + d)*(h[i + 1] - h[i])/(n[i + 1] - n[i]) +
+                                                          (n[i + 1] - n[i] - d)*(h[i] - h[i - 1])/(n[i] - n[i - 1]))
+                if not h[i - 1] < q < h[i + 1]:
+                    q = h[i] + float(d)*(h[i + d] - h[i])/(n[i + d] - n[i])
+
+                h[i] = q
+                n[i] += d
+
+    def get(self):
+        if self.heights != None:
+            return self.heights[2]
+        if len(self.samples) == 0:
+            return None
+
+        # nearest rank
+        return self.samples[int(math.ceil(self.p*len(self.samples))) - 1]
+
+class RollupBucket:
+    def __init__(self, bucket_time, schema, row = None):
+        self.time     = bucket_time
+        self.kinds    = schema.rollup_kinds
+        self.stored   = row != None
+        self.dirty    = False
+        self.base     = None
+        self.sketches = {} # index of a P95 column -> QuantileSketch
+
+        if row == None:
+            self.values = None
+            self.count  = 0
+        else:
+            self.values = list(row[:-1])
+            self.count  = row[-1]
+
+        for i, kind in enumerate(self.kinds):
+            if kind != P95:
+                continue
+
+            if row == None:
+                self.sketches[i] = QuantileSketch(ROLLUP_PERCENTILE/100.0)
+            else:
+                source = schema.rollup_sources[i]
+                self.sketches[i] = QuantileSketch(ROLLUP_PERCENTILE/100.0, self.count,
+                                                  self.values[schema.rollup_columns.index('{0}_{1}'.format(source, MIN))], self.values[i],
+                                                  self.values[schema.rollup_columns.index('{0}_{1}'.format(source, MAX))])
+
+    def add(self, values):
+        if self.values == None:
+            self.values = list(values)
+        else:
+            for i, kind in enumerate(self.kinds):
+                if kind == MAX:
+                    self.values[i] = max(self.values[i], values[i])
+                elif kind == MIN:
+                    self.values[i] = min(self.values[i], values[i])
+                elif kind == LAST:
+                    self.values[i] = values[i]
+                elif kind == SUM:
+                    self.values[i] += values[i]
+
+        for i, sketch in self.sketches.items():
+            sketch.add(values[i])
+            self.values[i] = int(round(sketch.get()))
+
+        self.count += 1
+        self.dirty  = True
+
+    def mark(self):
+        # Everything up to now was written to column files
+        self.base = (list(self.values), self.count)
+
+    def delta(self):
+        # The part of the bucket that is not in the column files yet. Summed
+        # up, the delta rows of a bucket give its values (LAST columns are
+        # read with MAX, they keep the current value).
+        if self.base == None:
+            return list(self.values), self.count
+
+        base_values, base_count = self.base
+        values = []
+        for kind, value, base_value in zip(self.kinds, self.values, base_values):
+            if kind == LAST:
+                values.append(value)
+            else:
+                values.append(value - base_value)
+
+        return values, self.count - base_count
+
 class ValueDB:
     air_quality_first_data = None
     gs_timer = 0
     gs_inter = 0
 
     def stop(self):
-        self.run = False
+        # None is queued behind all pending samples, so they are still
+        # written and committed before the thread ends. A slow disk only
+        # delays this, the samples are not given up.
         self.func_queue.put(None)
-        self.thread.join(2)
+        self.thread.join(STOP_WARNING_INTERVAL)
+        while self.thread.is_alive():
+            log.warning('Still writing queued samples ({0} left)'.format(self.func_queue.stats()['queued']))
+            self.thread.join(STOP_WARNING_INTERVAL)
+
+        for thread in self.read_threads:
+            self.read_queue.put(None)
+        for thread in self.read_threads:
+            thread.join(2)
+
+        if self.forward != None:
+            self.forward.stop()
+
+    def commit(self):
+        self.ingest_write()
+        self.rollup_checkpoint()
+
+        # The reader threads only see committed data. The graph cache gets
+        # every sample as it arrives, a reader that fills a cache entry from
+        # its snapshot adds the samples that are not committed yet. The
+        # generation tells it if its snapshot is still current.
+        with self.commit_lock:
+            self.db.commit()
+            if self.store != None:
+                self.store_write()
+            elif self.mirror != None:
+                self.mirror_write()
+            self.graph_cache_commit()
+            self.commit_generation += 1
+
+        if self.ingest_oldest != None:
+            self.commit_latency.add(time.monotonic() - self.ingest_oldest)
+            self.ingest_oldest = None
+
+        self.ingest_pending = 0
+
+    def commit_ingest(self):
+        # Samples are written into the open transaction and committed as a
+        # group every ingest_batch_size samples or ingest_batch_time ms, so
+        # we don't pay for one fsync per sample per sensor.
+        if self.ingest_pending == 0:
+            self.ingest_first_time = time.time()
+        self.ingest_pending += 1
+
+        if self.ingest_pending >= self.ingest_batch_size:
+            self.commit()
+
+    def ingest_commit_timeout(self):
+        if self.ingest_pending == 0:
+            return None
+        return max(0, self.ingest_first_time + self.ingest_batch_time/1000.0 - time.time())
+
+    def retention_timeout(self):
+        if len(self.retention_tables) == 0:
+            return None
+        return max(0, self.retention_next - time.time())
+
+    def retention_step(self):
+        # Rows older than the retention horizon are deleted in small batches
+        # and one table at a time, so the DB thread is never blocked for long.
+        # Once all tables are pruned the free pages are given back to the file
+        # system and we sleep for RETENTION_INTERVAL.
+        if self.store != None:
+            # column files are deleted a whole segment at a time
+            with self.commit_lock:
+                for table, suffix, horizon in self.retention_tables:
+                    self.store.prune(table, suffix, horizon)
+                self.rollup_recent.clear()
+
+            self.retention_next = time.time() + RETENTION_INTERVAL
+            return
+
+        table, suffix, horizon = self.retention_tables[self.retention_index]
+        table += suffix
+
+        self.dbc.execute('DELETE FROM {0} WHERE id IN (SELECT id FROM {0} WHERE time < ? LIMIT ?)'.format(table),
+                         (time.time() - horizon, RETENTION_BATCH_SIZE))
+        deleted = self.dbc.rowcount
+
+        if deleted > 0:
+            self.commit_ingest()
+
+        if deleted == RETENTION_BATCH_SIZE:
+            self.retention_next = time.time() + RETENTION_BATCH_INTERVAL
+            return
+
+        self.retention_index += 1
+        if self.retention_index < len(self.retention_tables):
+            self.retention_next = time.time() + RETENTION_BATCH_INTERVAL
+            return
+
+        # executescript() steps the pragma until it is done, execute() would
+        # only free a single page
+        self.commit()
+        self.db.executescript('PRAGMA incremental_vacuum({0})'.format(RETENTION_VACUUM_PAGES))
+
+        self.retention_index = 0
+        self.retention_next = time.time() + RETENTION_INTERVAL
+
+    def loop_timeout(self):
+        timeouts = [t for t in (self.ingest_commit_timeout(), self.retention_timeout(), self.settings_write_timeout()) if t != None]
+        if len(timeouts) == 0:
+            return None
+        return min(timeouts)
+
+    def run_timers(self):
+        if self.settings_write_timeout() == 0:
+            self.settings_write()
+
+        if self.ingest_commit_timeout() == 0:
+            self.commit()
+
+        if self.retention_timeout() == 0:
+            self.retention_step()
 
     def is_packaged(self):
         if self.packaged:
@@ -61,146 +901,417 @@ class ValueDB:
     def loop(self):
         db_name = '.weather_station.db'
 
-        if self.gui or self.is_packaged():
+        if self.db_path != None:
+            db_path = self.db_path
+        elif self.gui or self.is_packaged():
             db_path = os.path.join(os.path.expanduser('~'), db_name)
         else:
             db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), db_name)
 
         log.info('Using database: {0}'.format(db_path))
 
+        self.db_path = db_path
         self.db = sqlite3.connect(db_path)
         self.dbc = self.db.cursor()
         self.create()
 
+        self.dbc.execute('SELECT key, value FROM settings')
+        self.settings = dict(self.dbc.fetchall())
+
+        if self.backend == BACKEND_COLUMNAR:
+            store_path = os.path.splitext(db_path)[0] + '.columns'
+            log.info('Using column store: {0}'.format(store_path))
+            self.store = ColumnStore(store_path, ROLLUP_WIDE_COLUMNS)
+        elif self.rollup_mirror:
+            mirror_path = os.path.splitext(db_path)[0] + '.rollups'
+            log.info('Using rollup mirror: {0}'.format(mirror_path))
+            self.mirror = ColumnStore(mirror_path, ROLLUP_WIDE_COLUMNS)
+            self.mirror_sync()
+
+        for i in range(self.read_thread_count):
+            thread = threading.Thread(target=self.read_loop)
+            thread.daemon = True
+            thread.start()
+            self.read_threads.append(thread)
+
         self.init_handshake.release()
 
-        while self.run:
-            func_data = self.func_queue.get()
+        while True:
+            try:
+                request = self.func_queue.get(timeout=self.loop_timeout())
+            except queue.Empty:
+                self.run_timers()
+                continue
 
 
             if self.gs_timer==0:
                 self.gs_timer = time.time()
             elif self.gs_save_to_google_spreadsheet is not None and int(time.time() - self.gs_timer) >= self.gs_save_to_google_spreadsheet:
                 self.gs_timer = time.time()
-                if self.gs_inter == 0:  # push data to speadsheet periodically for different sensors
-                    self.dbc.execute('SELECT * FROM air_quality_day ORDER BY id')
-                    gs_values = self.dbc.fetchall()
-                    sheet = self.gs_client.open('TinkerForge_DataCollector').worksheet('AirQuality')
-                    sheet.update('A1',gs_values)
-                elif self.gs_inter == 1:
-                    self.dbc.execute('SELECT * FROM pm_concentration_day ORDER BY id')
-                    gs_values = self.dbc.fetchall()
-                    sheet = self.gs_client.open('TinkerForge_DataCollector').worksheet('PM_Concentration')
-                    sheet.update('A1',gs_values)
-                elif self.gs_inter == 2:
-                    self.dbc.execute('SELECT * FROM pm_count_day ORDER BY id')
-                    gs_values = self.dbc.fetchall()
-                    sheet = self.gs_client.open('TinkerForge_DataCollector').worksheet('PM_Count')
-                    sheet.update('A1',gs_values)
-                elif self.gs_inter == 3:
-                    self.dbc.execute('SELECT * FROM co2_day ORDER BY id')
-                    gs_values = self.dbc.fetchall()
-                    sheet = self.gs_client.open('TinkerForge_DataCollector').worksheet('CO2')
-                    sheet.update('A1',gs_values)
+                # push data to speadsheet periodically for different sensors
+                table, worksheet = GS_WORKSHEETS[self.gs_inter]
+                schema = TABLES[table]
+
+                # the columns the sheets had before the stat columns, their
+                # order in the table depends on the age of the database
+                columns = ['id', 'time'] + [column for column in schema.rollup_columns if column in schema.columns] + ['count']
+                self.dbc.execute('SELECT {0} FROM {1}_day ORDER BY id'.format(', '.join(columns), table))
+                gs_values = self.dbc.fetchall()
+                sheet = self.gs_client.open('TinkerForge_DataCollector').worksheet(worksheet)
+                sheet.update('A1',gs_values)
 
                 self.gs_inter += 1
-                self.gs_inter = self.gs_inter%4
+                self.gs_inter = self.gs_inter%len(GS_WORKSHEETS)
 
 
             
 
-            if func_data == None:
+            if request == None:
                 break
 
-            func, data = func_data
-            func(*data)
+            request.run()
+            self.run_timers()
+
+        # force a flush of settings and samples that are not yet committed
+        if len(self.settings_dirty) > 0:
+            self.settings_write()
+
+        if self.store != None:
+            # the open rollup buckets only exist in memory
+            self.rollup_checkpoint_next = 0
+            self.commit()
+            self.store.close()
+        elif self.mirror != None:
+            # the open buckets are mirrored as well, so every stored bucket up
+            # to the newest mirrored one is complete in the mirror
+            for key, bucket in self.rollup_buckets.items():
+                self.mirror_add(key, bucket)
+            self.commit()
+            self.mirror.close()
+            if not os.path.isdir(self.mirror.path):
+                # nothing was mirrored yet
+                os.makedirs(self.mirror.path)
+            with open(os.path.join(self.mirror.path, ROLLUP_MIRROR_CLEAN), 'w') as f:
+                f.write(str(ROLLUP_MIRROR_VERSION))
+        elif self.ingest_pending > 0:
+            self.commit()
 
         # unblock all pending calls
+        self.func_queue.close()
         while True:
             try:
-                self.func_queue.get(block=False)
-                self.func_queue_ret.put(None)
+                request = self.func_queue.get(block=False)
+                if request != None:
+                    request.cancel()
             except queue.Empty:
                 break
 
-    def set_setting(self, key, value):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.set_setting, (key, value)))
-            return
+    def read_loop(self):
+        db = sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(self.db_path)), uri=True)
+        self.read_local.dbc = db.cursor()
 
-        self.dbc.execute('REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-        self.db.commit()
+        while True:
+            request = self.read_queue.get()
+            if request == None:
+                break
 
-    def get_setting(self, key):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.get_setting, (key,)))
-            return self.func_queue_ret.get()
+            request.run()
 
-        try:
-            self.dbc.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            value = self.dbc.fetchone()[0]
-            self.func_queue_ret.put(value)
-        except:
-            self.func_queue_ret.put(None)
+        db.close()
 
-    def get_data(self, num, time_resolution, field, table, identifier = None, is_rain = False):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.get_data, (num, time_resolution, field, table, identifier, is_rain)))
-            return self.func_queue_ret.get()
+    def read_request(self, func, data):
+        future = Future()
+        self.read_queue.put(Request(func, data, future))
+        return future
+
+    def read_cursor(self):
+        # Cursor of the read-only connection of the current thread or None if
+        # we are not running in one of the reader threads
+        return getattr(self.read_local, 'dbc', None)
+
+    def set_setting(self, key, value):
+        # The new value is visible to get_setting immediately, the DB thread
+        # writes it after SETTINGS_WRITE_DELAY seconds without further
+        # changes, so dragging a slider results in a single write
+        self.settings[key] = value
+        self.func_queue.put(Request(self.settings_changed, (key,)))
+
+    def settings_changed(self, key):
+        self.settings_dirty.add(key)
+        self.settings_write_time = time.time() + SETTINGS_WRITE_DELAY
+
+    def settings_write_timeout(self):
+        if len(self.settings_dirty) == 0:
+            return None
+        return max(0, self.settings_write_time - time.time())
+
+    def settings_write(self):
+        for key in self.settings_dirty:
+            self.dbc.execute('REPLACE INTO settings (key, value) VALUES (?, ?)', (key, self.settings[key]))
+
+        self.settings_dirty = set()
+        self.commit()
+
+    def get_ingest_queue_stats(self):
+        # Samples waiting for the DB thread and per table the number of
+        # samples that were dropped or merged because the queue was full
+        return self.func_queue.stats()
+
+    def get_ingest_latency(self):
+        # Seconds from the arrival of a sample until the DB thread handled it
+        # (queue) and until it was committed (commit, oldest sample per commit)
+        return {'queue': self.queue_latency.get(), 'commit': self.commit_latency.get()}
+
+    def get_setting(self, key):
+        # All settings are loaded once at startup, no database access needed
+        return self.settings.get(key)
+
+    def get_setting_future(self, key):
+        future = Future()
+        future.set_result(self.get_setting(key))
+        return future
+
+    def get_data(self, num, time_resolution, field, table, identifier = None, is_rain = False, agg = AGG_AVG, timeout = None):
+        # agg selects what a slot shows: the average or the min, max or p95
+        # of the samples in it (ignored for rain). Slots without samples are
+        # None, they are not filled in.
+        check_get_data(table, field, is_rain, agg)
+
+        dbc = self.read_cursor()
+        if dbc == None:
+            return self.get_data_future(num, time_resolution, field, table, identifier, is_rain, agg).result(timeout)
+
+        if is_rain:
+            agg = AGG_AVG
+        elif agg == AGG_LTTB:
+            # three windows of num slots, whatever the time resolution
+            averages, minimums, maximums = [self.graph_cache_get((table, field, identifier, time_resolution, num, False, slot_agg)) or
+                                            self.get_data(num, time_resolution, field, table, identifier, False, slot_agg)
+                                            for slot_agg in (AGG_AVG, AGG_MIN, AGG_MAX)]
+            return downsample.lttb(averages, minimums, maximums)
+        elif TABLES[table].rollup_column(field, agg) == None:
+            raise ValueError('No {0} rollup for {1}.{2}'.format(agg, table, field))
+
+        key = (table, field, identifier, time_resolution, num, is_rain, agg)
 
-        count_str = 'count'
         if time_resolution < 60:
-            count_str = '1'
-            limit = num*time_resolution
+            suffix = ''
         elif time_resolution < 60*60:
-            limit = num*(time_resolution//60)
-            table += '_minute'
+            suffix = '_minute'
         elif time_resolution < 60*60*24:
-            limit = num*(time_resolution//(60*60))
-            table += '_hour'
+            suffix = '_hour'
         else:
-            limit = num*(time_resolution//(60*60*24))
-            table += '_day'
+            suffix = '_day'
+
+        while True:
+            with self.commit_lock:
+                generation = self.commit_generation
+                rollup_open = self.rollup_open
+
+            start = window_start(num, time_resolution)
+            store = self.store
+            if store == None and suffix in ROLLUP_MIRROR_SUFFIXES:
+                store = self.mirror
+
+            if store == None:
+                sums, counts = self.get_data_sqlite(dbc, num, time_resolution, field, table, suffix, identifier, is_rain, agg, start)
+            else:
+                sums, counts = self.get_data_columnar(store, num, time_resolution, field, table, suffix, identifier, is_rain, agg, start, rollup_open)
+
+            # Only keep the entry if there was no commit since our snapshot,
+            # otherwise the samples of that commit would be missing or counted
+            # twice. The next call tries again.
+            entry = GraphCacheEntry(num, time_resolution, field, is_rain, start, sums, counts, agg)
+            with self.commit_lock:
+                with self.graph_cache_lock:
+                    cached = generation == self.commit_generation
+                    if cached:
+                        # the snapshot lacks the samples since the last commit
+                        for sample in self.graph_cache_pending:
+                            if not self.graph_cache_entry_add(key, entry, *sample):
+                                cached = False
+                    if cached:
+                        self.graph_cache_put(key, entry)
+                    elif store != None:
+                        # the column files are no snapshot, read them again
+                        continue
+                    values = entry.get(time.time())
+
+            if cached:
+                self.pyramid_fill(key)
+
+            return values
+
+    def get_data_sqlite(self, dbc, num, time_resolution, field, table, suffix, identifier, is_rain, agg, start):
+        count_str = 'SUM(count)'
+        if suffix == '':
+            count_str = 'COUNT({0})'.format(field)
+
+        # Rollup rows from before the stat columns existed have NULL there,
+        # they are read as the average of their bucket
+        column = TABLES[table].rollup_column(field, agg)
+        if suffix != '':
+            column = 'COALESCE({0}, {1}*1.0/count)'.format(column, field)
+
+        if is_rain:
+            # rain is a counter, we need its last value per slot
+            value_str = 'MAX({0})'.format(field)
+            count_str = '1'
+        elif agg == AGG_P95 and suffix == '':
+            return self.get_data_sqlite_percentile(dbc, num, time_resolution, field, table, identifier, start)
+        elif agg == AGG_P95:
+            # the percentile of a slot with several buckets is estimated by
+            # the average of theirs, weighted by their number of samples
+            value_str = 'SUM({0}*count)'.format(column)
+        elif agg in (AGG_MIN, AGG_MAX):
+            value_str = '{0}({1})'.format(agg.upper(), field if suffix == '' else column)
+            count_str = '1'
+        else:
+            value_str = 'SUM({0})'.format(field)
+
+        # Select by time range instead of by number of rows, so gaps in the
+        # data don't stretch the time axis of the graph. The averaging per
+        # slot is done by sqlite, only num rows are returned.
+        query = 'SELECT CAST((time - ?)/? AS INTEGER) AS slot, {0}, {1} FROM {2} WHERE time >= ?'.format(value_str, count_str, table + suffix)
 
         if identifier == None:
-            self.dbc.execute('SELECT {0}, {1} FROM {2} ORDER BY id DESC LIMIT ?'.format(field, count_str, table), (limit,))
+            dbc.execute(query + ' GROUP BY slot', (start, time_resolution, start))
         else:
-            self.dbc.execute('SELECT {0}, {1} FROM {2} WHERE identifier = ? ORDER BY id DESC LIMIT ?'.format(field, count_str, table), (identifier, limit))
+            dbc.execute(query + ' AND identifier = ? GROUP BY slot', (start, time_resolution, start, identifier))
 
-        values = self.dbc.fetchall()
+        sums   = [None]*num
+        counts = [0]*num
+        for slot, value, count in dbc.fetchall():
+            if 0 <= slot < num and value != None:
+                sums[slot]   = value
+                counts[slot] = count
 
-        data_per_num = limit//num
-        averaged_values = []
+        return sums, counts
 
-        try:
-            for i in range(num):
-                v = 0.0
-                for j in range(data_per_num):
-                    index = i*data_per_num + j
-                    if is_rain:
-                        v = max(v, values[index][0])
-                    else:
-                        v += float(values[index][0]) / values[index][1]
-
-                if is_rain:
-                    averaged_values.append(v)
-                else:
-                    averaged_values.append(v/data_per_num)
-        except:
-            if j != 0:
-                if is_rain:
-                    averaged_values.append(v)
-                else:
-                    averaged_values.append(v/j)
+    def get_data_sqlite_percentile(self, dbc, num, time_resolution, field, table, identifier, start):
+        # sqlite has no percentile aggregate, the raw values of the window
+        # (less than a minute per slot) are sorted per slot by sqlite
+        query = 'SELECT CAST((time - ?)/? AS INTEGER) AS slot, {0} FROM {1} WHERE time >= ? AND {0} IS NOT NULL'.format(field, table)
 
-        if len(averaged_values) == 0:
-            averaged_values.append(0)
+        if identifier == None:
+            dbc.execute(query + ' ORDER BY slot, {0}'.format(field), (start, time_resolution, start))
+        else:
+            dbc.execute(query + ' AND identifier = ? ORDER BY slot, {0}'.format(field), (start, time_resolution, start, identifier))
+
+        samples = collections.defaultdict(list)
+        for slot, value in dbc.fetchall():
+            samples[slot].append(value)
+
+        return percentile_slots(num, samples)
+
+    def get_data_columnar(self, store, num, time_resolution, field, table, suffix, identifier, is_rain, agg, start, rollup_open):
+        # Same aggregation as get_data_sqlite, but over a slice of the column
+        # files. A rollup bucket can consist of several partial rows and of the
+        # part in the open bucket that is not written yet, they are added up
+        # per bucket first.
+        if suffix == '':
+            times, (values,) = store.read_columns(table, suffix, identifier, [field], start)
+            bucket_counts = [1]*len(times)
+        else:
+            column = field if is_rain else TABLES[table].rollup_column(field, agg)
+            times, (values, bucket_counts) = store.read_columns(table, suffix, identifier, [column, 'count'], start)
+
+            bucket = rollup_open.get((table, suffix, identifier))
+            if bucket != None and bucket[0] >= start:
+                bucket_time, rollup_columns, bucket_values, count = bucket
+                times.append(bucket_time)
+                values.append(bucket_values[rollup_columns.index(column)])
+                bucket_counts.append(count)
+
+            buckets = collections.OrderedDict()
+            for t, value, count in zip(times, values, bucket_counts):
+                if value == None:
+                    continue
+                if t in buckets:
+                    # LAST columns (rain) keep the current value in every row
+                    bucket = buckets[t]
+                    bucket[0] = max(bucket[0], value) if is_rain else bucket[0] + value
+                    bucket[1] += count
+                else:
+                    buckets[t] = [value, count]
+
+            times = list(buckets)
+            values = [bucket[0] for bucket in buckets.values()]
+            bucket_counts = [bucket[1] for bucket in buckets.values()]
+
+        sums    = [None]*num
+        counts  = [0]*num
+        samples = collections.defaultdict(list)
+        for i, t in enumerate(times):
+            slot = int(t - start)//time_resolution
+            if slot < 0 or slot >= num or values[i] == None:
+                continue
+
+            if is_rain or agg == AGG_MAX:
+                sums[slot]   = values[i] if sums[slot] == None else max(sums[slot], values[i])
+                counts[slot] = 1
+            elif agg == AGG_MIN:
+                sums[slot]   = values[i] if sums[slot] == None else min(sums[slot], values[i])
+                counts[slot] = 1
+            elif agg == AGG_P95 and suffix == '':
+                samples[slot].append(values[i])
+            elif agg == AGG_P95:
+                sums[slot]   = values[i]*bucket_counts[i] + (sums[slot] or 0)
+                counts[slot] += bucket_counts[i]
+            else:
+                sums[slot]   = values[i] if sums[slot] == None else sums[slot] + values[i]
+                counts[slot] += bucket_counts[i]
+
+        if agg == AGG_P95 and suffix == '':
+            for slot in samples:
+                samples[slot].sort()
+            return percentile_slots(num, samples)
+
+        return sums, counts
+
+    def pyramid_fill(self, key):
+        # A graph was read with one of the pyramid resolutions, the same
+        # graph is read for all other pyramid resolutions in the background.
+        # These entries are never dropped and are kept up to date with every
+        # commit, so switching the resolution of a graph needs no query and
+        # every refresh reads num values, whatever the resolution. A
+        # percentile can't be kept up to date, it is not part of the pyramid.
+        table, field, identifier, time_resolution, num, is_rain, agg = key
+        if time_resolution not in self.pyramid or agg == AGG_P95:
+            return
 
-        ret = [averaged_values[-1]]*(num-len(averaged_values))
-        for value in reversed(averaged_values):
-            ret.append(value)
+        with self.graph_cache_lock:
+            for resolution in self.pyramid:
+                other = (table, field, identifier, resolution, num, is_rain, agg)
+                if other not in self.graph_cache and other not in self.pyramid_pending:
+                    self.pyramid_pending.add(other)
+                    self.read_queue.put(Request(self.pyramid_read, (other,)))
 
-        self.func_queue_ret.put(ret)
+    def pyramid_read(self, key):
+        table, field, identifier, time_resolution, num, is_rain, agg = key
+        try:
+            self.get_data(num, time_resolution, field, table, identifier, is_rain, agg)
+        finally:
+            # if a commit came in between the entry was not kept, the next
+            # read of the graph tries again
+            with self.graph_cache_lock:
+                self.pyramid_pending.discard(key)
+
+    def graph_cache_get(self, key):
+        with self.graph_cache_lock:
+            entry = self.graph_cache.get(key)
+            if entry == None:
+                return None
+            return entry.get(time.time())
+
+    def get_data_future(self, num, time_resolution, field, table, identifier = None, is_rain = False, agg = AGG_AVG):
+        values = self.graph_cache_get((table, field, identifier, time_resolution, num, is_rain, AGG_AVG if is_rain else agg))
+        if values != None:
+            future = Future()
+            future.set_result(values)
+            return future
+
+        return self.read_request(self.get_data, (num, time_resolution, field, table, identifier, is_rain, agg))
 
     def get_data_air_quality(self, num, time_resolution, field):
         return self.get_data(num, time_resolution, field, 'air_quality')
@@ -212,739 +1323,513 @@ class ValueDB:
         return self.get_data(num, time_resolution, field, 'sensor', identifier)
 
     def get_data_rain_period_list(self, num, rain_period, identifier):
-        values = self.get_data(num+1, rain_period, 'rain', 'station', identifier, True)
-        rain_values = []
-        for i in range(1, len(values)):
-            rain_values.append(values[i] - values[i-1])
-
-        return rain_values
+        return rain_differences(self.get_data(num+1, rain_period, 'rain', 'station', identifier, True))
+
+    def get_data_rain_period(self, identifier, rain_period, timeout = None):
+        dbc = self.read_cursor()
+        if dbc == None:
+            return self.get_data_rain_period_future(identifier, rain_period).result(timeout)
+
+        key = (identifier, rain_period)
+        with self.graph_cache_lock:
+            window = self.rain_windows.get(key)
+            if window != None:
+                return window.get(time.time())
+
+        # The rain values of the period are read once, then every new sample
+        # is added (see graph_cache_add). Like a graph cache entry the window
+        # is only kept if there was no commit since our snapshot.
+        while True:
+            with self.commit_lock:
+                generation = self.commit_generation
+
+            start = time.time() - rain_period
+            if self.store != None:
+                rows = [(t, rain) for t, rain in self.store.read('station', '', identifier, ['rain'], start) if t > start and rain != None]
+            else:
+                dbc.execute('SELECT time, rain FROM station WHERE identifier = ? AND time > ? AND rain IS NOT NULL ORDER BY time', (identifier, start))
+                rows = dbc.fetchall()
+
+            window = RainWindow(rain_period, rows)
+            with self.commit_lock:
+                with self.graph_cache_lock:
+                    if generation == self.commit_generation:
+                        for table, sample_identifier, columns, values, sample_time in self.graph_cache_pending:
+                            if table == 'station' and sample_identifier == identifier:
+                                window.add(sample_time, values[columns.index('rain')])
+                        self.rain_windows[key] = window
+                    elif self.store != None:
+                        # the column files are no snapshot, read them again
+                        continue
+                    return window.get(time.time())
+
+    def get_data_rain_period_future(self, identifier, rain_period):
+        with self.graph_cache_lock:
+            window = self.rain_windows.get((identifier, rain_period))
+            if window != None:
+                future = Future()
+                future.set_result(window.get(time.time()))
+                return future
+
+        return self.read_request(self.get_data_rain_period, (identifier, rain_period))
+
+    def add_data(self, table, identifier, values, timestamp = None, block = True):
+        # The sample time is taken when the value arrives (or given by the
+        # caller as Timestamp or as unix time for backfill), not when the DB
+        # thread gets to it, so a backlog in the queue doesn't shift it
+        if timestamp == None:
+            timestamp = sample_timestamp()
+        elif not isinstance(timestamp, Timestamp):
+            timestamp = Timestamp(timestamp, None)
 
-    def get_data_rain_period(self, identifier, rain_period):
         if threading.current_thread() != self.thread:
-            self.func_queue.put((self.get_data_rain_period, (identifier, rain_period)))
-            return self.func_queue_ret.get()
+            # with block = False nothing is done and False is returned if
+            # we would have to wait for space in the ingest queue
+            schema = TABLES[table]
+            if not self.func_queue.put_sample(SampleRequest(self.add_data, table, identifier, values, timestamp),
+                                              self.ingest_policy.get(table, QUEUE_BLOCK), schema.kinds, block):
+                return False
+
+            if self.forward != None:
+                self.forward.add(table, identifier, values, timestamp.wall)
+            return True
 
-        try:
-            self.dbc.execute('SELECT rain FROM station WHERE identifier = ? ORDER BY id DESC LIMIT 1', (identifier, ))
-            period_end_rain = self.dbc.fetchone()[0]
+        if timestamp.monotonic != None:
+            self.queue_latency.add(time.monotonic() - timestamp.monotonic)
+            if self.ingest_oldest == None or timestamp.monotonic < self.ingest_oldest:
+                self.ingest_oldest = timestamp.monotonic
 
-            t = time.time() - rain_period
-            self.dbc.execute('SELECT rain, time FROM station WHERE identifier = ? AND time > ? ORDER BY time ASC LIMIT 1', (identifier, t))
-            period_start_rain = self.dbc.fetchone()[0]
+        schema = TABLES[table]
+        sample_time = round(timestamp.wall, 3) # raw rows keep ms, buckets use seconds
+        now = int(sample_time)
 
-            period_rain = max(0, period_end_rain - period_start_rain)
-            self.func_queue_ret.put(period_rain)
-        except:
-            self.func_queue_ret.put(None)
+        # Raw rows are collected in memory and written with one executemany
+        # per table when the group is committed
+        self.ingest_rows[table].append(schema.key(sample_time, identifier) + list(values))
+        with self.graph_cache_lock:
+            self.graph_cache_pending.append((table, identifier, schema.columns, values, sample_time))
+            self.graph_cache_add(table, identifier, schema.columns, values, sample_time)
 
-    def add_data_air_quality(self, iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_air_quality, (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)))
-            return
+        values = dict(zip(schema.columns, values))
+        self.rollup_add(schema, identifier, [values[column] for column in schema.rollup_sources], now)
 
-        self.dbc.execute("""
-            INSERT INTO air_quality (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-            VALUES (?, ?, ?, ?, ?)""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            UPDATE air_quality_minute
-            SET iaq_index          = iaq_index + ?,
-                iaq_index_accuracy = iaq_index_accuracy + ?,
-                temperature        = temperature + ?,
-                humidity           = humidity + ?,
-                air_pressure       = air_pressure + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO air_quality_minute (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-            VALUES (?, ?, ?, ?, ?)""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            UPDATE air_quality_hour
-            SET iaq_index          = iaq_index + ?,
-                iaq_index_accuracy = iaq_index_accuracy + ?,
-                temperature        = temperature + ?,
-                humidity           = humidity + ?,
-                air_pressure       = air_pressure + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO air_quality_hour (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-            VALUES (?, ?, ?, ?, ?)""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            UPDATE air_quality_day
-            SET iaq_index          = iaq_index + ?,
-                iaq_index_accuracy = iaq_index_accuracy + ?,
-                temperature        = temperature + ?,
-                humidity           = humidity + ?,
-                air_pressure       = air_pressure + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO air_quality_day (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-            VALUES (?, ?, ?, ?, ?)""",
-            (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure)
-        )
+        self.commit_ingest()
 
-        self.db.commit()
+    def add_data_air_quality(self, iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure, timestamp = None):
+        self.add_data('air_quality', None, (iaq_index, iaq_index_accuracy, temperature, humidity, air_pressure), timestamp)
 
+    def add_data_pm_concentration(self, pm10, pm25, pm100, timestamp = None):
+        self.add_data('pm_concentration', None, (pm10, pm25, pm100), timestamp)
 
-    def add_data_pm_concentration(self, pm10, pm25, pm100):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_pm_concentration, (pm10, pm25, pm100)))
-            return
+    def add_data_pm_count(self, greater03um, greater05um, greater10um, greater25um, greater50um, greater100um, timestamp = None):
+        self.add_data('pm_count', None, (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um), timestamp)
 
-        self.dbc.execute("""
-            INSERT INTO pm_concentration (pm10, pm25, pm100)
-            VALUES (?, ?, ?)""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_concentration_minute
-            SET pm10          = pm10 + ?,
-                pm25 = pm25 + ?,
-                pm100        = pm100 + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_concentration_minute (pm10, pm25, pm100)
-            VALUES (?, ?, ?)""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_concentration_hour
-            SET pm10          = pm10 + ?,
-                pm25 = pm25 + ?,
-                pm100        = pm100 + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_concentration_hour (pm10, pm25, pm100)
-            VALUES (?, ?, ?)""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_concentration_day
-            SET pm10          = pm10 + ?,
-                pm25 = pm25 + ?,
-                pm100        = pm100 + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))""",
-            (pm10, pm25, pm100)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_concentration_day (pm10, pm25, pm100)
-            VALUES (?, ?, ?)""",
-            (pm10, pm25, pm100)
-        )
+    def add_data_co2(self, co2_concentration, temperature, humidity, timestamp = None):
+        self.add_data('co2', None, (co2_concentration, temperature, humidity), timestamp)
 
-        self.db.commit()
+    def add_data_station(self, identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low, timestamp = None):
+        self.add_data('station', identifier, (temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low), timestamp)
 
+    def add_data_sensor(self, identifier, temperature, humidity, timestamp = None):
+        self.add_data('sensor', identifier, (temperature, humidity), timestamp)
 
-    def add_data_pm_count(self, greater03um, greater05um, greater10um, greater25um, greater50um, greater100um):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_pm_count, (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)))
+    def ingest_write(self):
+        if self.store != None:
+            # written by store_write under commit_lock
             return
 
-        self.dbc.execute("""
-            INSERT INTO pm_count (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_count_minute
-            SET greater03um          = greater03um + ?,
-                greater05um = greater05um + ?,
-                greater10um        = greater10um + ?,
-                greater25um        = greater25um + ?,
-                greater50um        = greater50um + ?,
-                greater100um        = greater100um + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_count_minute (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_count_hour
-            SET greater03um          = greater03um + ?,
-                greater05um = greater05um + ?,
-                greater10um        = greater10um + ?,
-                greater25um        = greater25um + ?,
-                greater50um        = greater50um + ?,
-                greater100um        = greater100um + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_count_hour (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            UPDATE pm_count_day
-            SET greater03um          = greater03um + ?,
-                greater05um = greater05um + ?,
-                greater10um        = greater10um + ?,
-                greater25um        = greater25um + ?,
-                greater50um        = greater50um + ?,
-                greater100um        = greater100um + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO pm_count_day (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (greater03um, greater05um, greater10um, greater25um, greater50um, greater100um)
-        )
+        for table, rows in self.ingest_rows.items():
+            if len(rows) > 0:
+                self.dbc.executemany(TABLES[table].insert_sql, rows)
+                self.ingest_rows[table] = []
+
+    def store_write(self):
+        # Append the samples and rollup rows of this commit to the column
+        # files and publish the open rollup buckets for the readers
+        for table, rows in self.ingest_rows.items():
+            schema = TABLES[table]
+            series = collections.OrderedDict()
+            for row in rows:
+                if schema.identifier:
+                    series.setdefault(row[1], []).append([row[0]] + row[2:])
+                else:
+                    series.setdefault(None, []).append(row)
 
-        self.db.commit()
+            for identifier, series_rows in series.items():
+                self.store.append(table, '', identifier, schema.columns, series_rows)
 
-    def add_data_co2(self, co2_concentration, temperature, humidity):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_co2, (co2_concentration, temperature, humidity)))
-            return
+            self.ingest_rows[table] = []
 
-        self.dbc.execute("""
-            INSERT INTO co2 (co2_concentration, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (co2_concentration, temperature, humidity)
-        )
-
-
-        self.dbc.execute("""
-            UPDATE co2_minute
-            SET co2_concentration          = co2_concentration + ?,
-                temperature = temperature + ?,
-                humidity        = humidity + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))""",
-            (co2_concentration, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO co2_minute (co2_concentration, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (co2_concentration, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            UPDATE co2_hour
-            SET co2_concentration          = co2_concentration + ?,
-                temperature = temperature + ?,
-                humidity        = humidity + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))""",
-            (co2_concentration, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO co2_hour (co2_concentration, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (co2_concentration, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            UPDATE co2_day
-            SET co2_concentration          = co2_concentration + ?,
-                temperature = temperature + ?,
-                humidity        = humidity + ?,
-                count              = count + 1
-            WHERE time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))""",
-            (co2_concentration, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO co2_day (co2_concentration, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (co2_concentration, temperature, humidity)
-        )
+        for (table, suffix, identifier), rows in self.rollup_rows.items():
+            self.store.append(table, suffix, identifier, TABLES[table].rollup_columns + ['count'], rows)
+        self.rollup_rows = collections.OrderedDict()
 
-        self.db.commit()
+        self.store.flush()
+        self.rollup_publish()
 
-    def add_data_station(self, identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_station, (identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low)))
-            return
+    def rollup_publish(self):
+        # Snapshot of the part of the open buckets that is not in the column
+        # files yet, readers add it to what they read from the files
+        rollup_open = {}
+        for key, bucket in self.rollup_buckets.items():
+            if bucket.count > 0:
+                values, count = bucket.delta()
+                if count > 0:
+                    rollup_open[key] = (bucket.time, TABLES[key[0]].rollup_columns, values, count)
 
-        self.dbc.execute("""
-            INSERT INTO station (identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (identifier, temperature, humidity, wind_speed, gust_speed, rain, wind_direction, battery_low)
-        )
-
-        self.dbc.execute("""
-            UPDATE station_minute
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                wind_speed  = wind_speed + ?,
-                gust_speed  = MAX(gust_speed, ?),
-                rain        = ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))) AND (identifier = ?)""",
-            (temperature, humidity, wind_speed, gust_speed, rain, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO station_minute (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-        )
-
-        self.dbc.execute("""
-            UPDATE station_hour
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                wind_speed  = wind_speed + ?,
-                gust_speed  = MAX(gust_speed, ?),
-                rain        = ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))) AND (identifier = ?)""",
-            (temperature, humidity, wind_speed, gust_speed, rain, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO station_hour (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-        )
-
-        self.dbc.execute("""
-            UPDATE station_day
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                wind_speed  = wind_speed + ?,
-                gust_speed  = MAX(gust_speed, ?),
-                rain        = ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))) AND (identifier = ?)""",
-            (temperature, humidity, wind_speed, gust_speed, rain, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO station_day (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (identifier, temperature, humidity, wind_speed, gust_speed, rain)
-        )
+        self.rollup_open = rollup_open
 
-        self.db.commit()
+    def mirror_write(self):
+        for (table, suffix, identifier), rows in self.mirror_rows.items():
+            self.mirror.append(table, suffix, identifier, TABLES[table].rollup_columns + ['count'], rows)
+        self.mirror_rows = collections.OrderedDict()
 
-    def add_data_sensor(self, identifier, temperature, humidity):
-        if threading.current_thread() != self.thread:
-            self.func_queue.put((self.add_data_sensor, (identifier, temperature, humidity)))
+        self.mirror.flush()
+        self.rollup_publish()
+
+    def mirror_add(self, key, bucket):
+        # A closed bucket is mirrored as the change since it was last
+        # mirrored, so a bucket that is reopened by a backfilled sample or by
+        # a clock that goes backwards is not counted twice
+        if self.mirror == None or key[1] not in ROLLUP_MIRROR_SUFFIXES or bucket.count == 0:
             return
 
-        self.dbc.execute("""
-            INSERT INTO sensor (identifier, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (identifier, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            UPDATE sensor_minute
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 60))) AND (identifier = ?)""",
-            (temperature, humidity, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO sensor_minute (identifier, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (identifier, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            UPDATE sensor_hour
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 3600))) AND (identifier = ?)""",
-            (temperature, humidity, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO sensor_hour (identifier, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (identifier, temperature, humidity)
-        )
-
-        self.dbc.execute("""
-            UPDATE sensor_day
-            SET temperature = temperature + ?,
-                humidity    = humidity + ?,
-                count       = count + 1
-            WHERE (time = (strftime('%s', 'now') - (strftime('%s', 'now') % 86400))) AND (identifier = ?)""",
-            (temperature, humidity, identifier)
-        )
-
-        self.dbc.execute("""
-            INSERT OR IGNORE INTO sensor_day (identifier, temperature, humidity)
-            VALUES (?, ?, ?)""",
-            (identifier, temperature, humidity)
-        )
+        values, count = bucket.delta()
+        if count == 0:
+            return
 
-        self.db.commit()
+        self.mirror_rows.setdefault(key, []).append([bucket.time] + values + [count])
+        self.mirror_last[key] = max(bucket.time, self.mirror_last.get(key, -1))
+        bucket.mark()
+
+    def mirror_sync(self):
+        # Append the buckets that were closed while the mirror was not
+        # updated (first start, older version). A mirror that is ahead of the
+        # database belongs to another database and is rebuilt. After a crash
+        # the changes of the buckets that were open are missing, the whole
+        # mirror is rebuilt then.
+        now = int(time.time())
+
+        clean = os.path.join(self.mirror.path, ROLLUP_MIRROR_CLEAN)
+        version = None
+        if os.path.exists(clean):
+            with open(clean) as f:
+                version = f.read().strip()
+            os.remove(clean)
+
+        if version != str(ROLLUP_MIRROR_VERSION) and os.path.isdir(self.mirror.path):
+            if version == None:
+                log.warning('Rollup mirror was not closed cleanly, rebuilding it')
+            else:
+                log.info('Rollup mirror has another format, rebuilding it')
+            shutil.rmtree(self.mirror.path)
+            self.mirror = ColumnStore(self.mirror.path, ROLLUP_WIDE_COLUMNS)
+
+        for schema in TABLES.values():
+            for suffix in ROLLUP_MIRROR_SUFFIXES:
+                table = schema.name + suffix
+                seconds = dict(ROLLUP_RESOLUTIONS)[suffix]
+                columns = schema.rollup_columns + ['count']
+
+                if schema.identifier:
+                    self.dbc.execute('SELECT DISTINCT identifier FROM {0}'.format(table))
+                    identifiers = set(row[0] for row in self.dbc.fetchall())
+
+                    # series that only exist in the mirror are dropped below
+                    identifiers.update(self.mirror.identifiers(schema.name, suffix))
+                else:
+                    identifiers = [None]
+
+                for identifier in identifiers:
+                    where = ''
+                    args = []
+                    if schema.identifier:
+                        # IS also matches rows without identifier
+                        where = ' AND identifier IS ?'
+                        args = [identifier]
+
+                    self.dbc.execute('SELECT MAX(time) FROM {0} WHERE 1{1}'.format(table, where), args)
+                    newest = self.dbc.fetchone()[0]
+
+                    last = self.mirror.last(schema.name, suffix, identifier, ['count'])
+                    if last != None and (newest == None or last[0] > newest):
+                        self.mirror.drop(schema.name, suffix, identifier)
+                        last = None
+                    last = -1 if last == None else int(last[0])
+
+                    self.dbc.execute('SELECT time, {0} FROM {1} WHERE time > ? AND time < ?{2} ORDER BY time'.format(', '.join(columns), table, where),
+                                     [last, now - now % seconds] + args)
+                    rows = [[row[0]] + schema.rollup_fill(row[1:]) for row in self.dbc.fetchall()]
+                    if len(rows) > 0:
+                        self.mirror.append(schema.name, suffix, identifier, columns, rows)
+                        last = rows[-1][0]
+
+                    self.mirror_last[(schema.name, suffix, identifier)] = last
+
+                    # the open bucket is served from memory until it closes
+                    bucket = self.rollup_load(schema, suffix, identifier, now - now % seconds)
+                    if bucket.count > 0:
+                        self.rollup_buckets[(schema.name, suffix, identifier)] = bucket
+
+        self.mirror.flush()
+        self.rollup_publish()
+
+    def rollup_add(self, schema, identifier, values, now):
+        # The currently open minute/hour/day bucket of every table is kept in
+        # memory. Bucket rows are only written when the bucket closes or when
+        # the open buckets are checkpointed together with the next commit.
+        current = int(time.time())
+        for suffix, seconds in ROLLUP_RESOLUTIONS:
+            key = (schema.name, suffix, identifier)
+            bucket_time = now - now % seconds
+            bucket = self.rollup_buckets.get(key)
+
+            if bucket_time > current - current % seconds:
+                # A sample from the future (given by the caller) must not
+                # close the open bucket, its bucket is written right away
+                # and continued once it is the current one
+                future = self.rollup_load(schema, suffix, identifier, bucket_time)
+                future.add(values)
+                self.rollup_write([(key, future)])
+                continue
+
+            if bucket != None and bucket.time != bucket_time:
+                self.rollup_write([(key, bucket)])
+                self.mirror_add(key, bucket)
+                bucket = None
+
+            if bucket == None:
+                bucket = self.rollup_load(schema, suffix, identifier, bucket_time)
+                self.rollup_buckets[key] = bucket
+
+            bucket.add(values)
+
+    def graph_cache_entry_add(self, key, entry, table, identifier, columns, values, sample_time):
+        # Returns False if the entry has to be dropped: a percentile can't
+        # be updated sample by sample, the next get_data reads it again
+        if key[0] != table or key[2] != identifier or entry.field not in columns:
+            return True
+        if entry.agg == AGG_P95:
+            return False
+
+        entry.add(sample_time, values[columns.index(entry.field)])
+        return True
+
+    def graph_cache_add(self, table, identifier, columns, values, sample_time):
+        # Called by the DB thread with graph_cache_lock held for every new
+        # sample, so the graphs show it before it is committed
+        series = self.graph_cache_series.get((table, identifier))
+        for key, entry in list(series.items()) if series != None else []:
+            if not self.graph_cache_entry_add(key, entry, table, identifier, columns, values, sample_time):
+                self.graph_cache_drop(key)
+
+        if table == 'station':
+            for (window_identifier, rain_period), window in self.rain_windows.items():
+                if window_identifier == identifier:
+                    window.add(sample_time, values[columns.index('rain')])
+
+    def graph_cache_put(self, key, entry):
+        # graph_cache_series has the entries of every table and sensor, so a
+        # sample only visits the entries it changes
+        self.graph_cache[key] = entry
+        self.graph_cache_series.setdefault((key[0], key[2]), {})[key] = entry
+
+    def graph_cache_drop(self, key):
+        self.graph_cache.pop(key, None)
+        series = self.graph_cache_series.get((key[0], key[2]))
+        if series != None:
+            series.pop(key, None)
+            if len(series) == 0:
+                del self.graph_cache_series[(key[0], key[2])]
+
+    def graph_cache_commit(self):
+        # The pending samples are part of the committed data now
+        now = time.time()
+
+        with self.graph_cache_lock:
+            for key, entry in list(self.graph_cache.items()):
+                if now - entry.last_access > GRAPH_CACHE_TIMEOUT and (key[3] not in self.pyramid or entry.agg == AGG_P95):
+                    self.graph_cache_drop(key)
+
+            for key, window in list(self.rain_windows.items()):
+                if now - window.last_access > GRAPH_CACHE_TIMEOUT:
+                    del self.rain_windows[key]
+
+            self.graph_cache_pending = []
+
+    def rollup_load(self, schema, suffix, identifier, bucket_time):
+        if self.store != None:
+            return self.rollup_load_columnar(schema, suffix, identifier, bucket_time)
+
+        # Continue a bucket that was already written before a restart
+        self.dbc.execute(schema.rollup_select_sql.format(schema.name + suffix), schema.key(bucket_time, identifier))
+        row = self.dbc.fetchone()
+        bucket = RollupBucket(bucket_time, schema, None if row == None else schema.rollup_fill(row))
+
+        # buckets up to the newest mirrored one are in the mirror already
+        if bucket.stored and bucket_time <= self.mirror_last.get((schema.name, suffix, identifier), -1):
+            bucket.mark()
+
+        return bucket
+
+    def rollup_load_columnar(self, schema, suffix, identifier, bucket_time):
+        # Rows that were already written for this bucket stay in the column
+        # files. The bucket continues from their total (the sum of the delta
+        # rows), so its delta rows keep adding up to the right min/max/p95.
+        key = (schema.name, suffix, identifier)
+        bucket = self.rollup_recent.pop((key, bucket_time), None)
+        if bucket != None:
+            return bucket
+
+        last = self.rollup_last.get(key)
+        if last == None:
+            row = self.store.last(schema.name, suffix, identifier, ['count'])
+            last = -1 if row == None else row[0]
+            self.rollup_last[key] = last
+
+        if bucket_time > last:
+            return RollupBucket(bucket_time, schema)
+
+        columns = schema.rollup_columns + ['count']
+        times, values = self.store.read_columns(schema.name, suffix, identifier, columns, bucket_time, bucket_time + 1)
+        for row in self.rollup_rows.get(key, []):
+            # not appended to the column files yet
+            if row[0] == bucket_time:
+                times.append(row[0])
+                for i, value in enumerate(row[1:]):
+                    values[i].append(value)
+
+        if len(times) == 0:
+            return RollupBucket(bucket_time, schema)
+
+        row = []
+        for kind, column in zip(schema.rollup_kinds + [SUM], values):
+            # columns added after a row was written are missing there
+            present = [value for value in column if value != None]
+            if len(present) == 0:
+                row.append(None)
+            else:
+                row.append(present[-1] if kind == LAST else sum(present))
+
+        bucket = RollupBucket(bucket_time, schema, schema.rollup_fill(row))
+        bucket.mark()
+        return bucket
+
+    def rollup_write(self, buckets):
+        # Write dirty buckets with one executemany per statement
+        updates = collections.defaultdict(list)
+        inserts = collections.defaultdict(list)
+
+        for (table, suffix, identifier), bucket in buckets:
+            if not bucket.dirty:
+                continue
+
+            if self.store != None:
+                # Column files are append only, the bucket is written as a
+                # row with the changes since the last write
+                values, count = bucket.delta()
+                self.rollup_rows.setdefault((table, suffix, identifier), []).append([bucket.time] + values + [count])
+                self.rollup_last[(table, suffix, identifier)] = max(bucket.time, self.rollup_last.get((table, suffix, identifier), -1))
+                bucket.mark()
+                bucket.dirty = False
+
+                self.rollup_recent[((table, suffix, identifier), bucket.time)] = bucket
+                self.rollup_recent.move_to_end(((table, suffix, identifier), bucket.time))
+                if len(self.rollup_recent) > ROLLUP_RECENT_BUCKETS:
+                    self.rollup_recent.popitem(False)
+                continue
+
+            key = TABLES[table].key(bucket.time, identifier)
+            if bucket.stored:
+                updates[(table, suffix)].append(bucket.values + [bucket.count] + key)
+            else:
+                inserts[(table, suffix)].append(key + bucket.values + [bucket.count])
+
+            bucket.stored = True
+            bucket.dirty  = False
+
+        for (table, suffix), rows in updates.items():
+            self.dbc.executemany(TABLES[table].rollup_update_sql.format(table + suffix), rows)
+        for (table, suffix), rows in inserts.items():
+            self.dbc.executemany(TABLES[table].rollup_insert_sql.format(table + suffix), rows)
+
+    def rollup_checkpoint(self):
+        if self.store != None:
+            if time.time() < self.rollup_checkpoint_next:
+                return
+            self.rollup_checkpoint_next = time.time() + ROLLUP_CHECKPOINT_INTERVAL
+
+        self.rollup_write(self.rollup_buckets.items())
 
     def create(self):
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS air_quality (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                iaq_index integer,
-                iaq_index_accuracy integer,
-                temperature integer,
-                humidity integer,
-                air_pressure integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS air_quality_minute (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                iaq_index integer,
-                iaq_index_accuracy integer,
-                temperature integer,
-                humidity integer,
-                air_pressure integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS air_quality_hour (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                iaq_index integer,
-                iaq_index_accuracy integer,
-                temperature integer,
-                humidity integer,
-                air_pressure integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS air_quality_day (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                iaq_index integer,
-                iaq_index_accuracy integer,
-                temperature integer,
-                humidity integer,
-                air_pressure integer,
-                count integer default 1
-            )"""
-        )
-
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_concentration (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                pm10 integer,
-                pm25 integer,
-                pm100 integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_concentration_minute (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                pm10 integer,
-                pm25 integer,
-                pm100 integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_concentration_hour (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                pm10 integer,
-                pm25 integer,
-                pm100 integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_concentration_day (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                pm10 integer,
-                pm25 integer,
-                pm100 integer,
-                count integer default 1
-            )"""
-        )
-
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_count (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                greater03um integer, 
-                greater05um integer,
-                greater10um integer,
-                greater25um integer,
-                greater50um integer,
-                greater100um integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_count_minute (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                greater03um integer, 
-                greater05um integer,
-                greater10um integer,
-                greater25um integer,
-                greater50um integer,
-                greater100um integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_count_hour (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                greater03um integer, 
-                greater05um integer,
-                greater10um integer,
-                greater25um integer,
-                greater50um integer,
-                greater100um integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS pm_count_day (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                greater03um integer, 
-                greater05um integer,
-                greater10um integer,
-                greater25um integer,
-                greater50um integer,
-                greater100um integer,
-                count integer default 1
-            )"""
-        )
-
-
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS co2 (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                co2_concentration integer,
-                temperature integer,
-                humidity integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS co2_minute (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                co2_concentration integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS co2_hour (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                co2_concentration integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS co2_day (
-                id integer primary key,
-                time timestamp unique default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                co2_concentration integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1
-            )"""
-        )
-
-
-
-
-
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS station (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                wind_speed integer,
-                gust_speed integer,
-                rain integer,
-                wind_direction integer,
-                battery_low integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS station_minute (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                wind_speed integer,
-                gust_speed integer,
-                rain integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS station_hour (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                wind_speed integer,
-                gust_speed integer,
-                rain integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS station_day (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                wind_speed integer,
-                gust_speed integer,
-                rain integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS sensor (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now')),
-                identifier integer,
-                temperature integer,
-                humidity integer
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_minute (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%60)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_hour (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%3600)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_day (
-                id integer primary key,
-                time timestamp default (strftime('%s', 'now') - (strftime('%s', 'now')%86400)),
-                identifier integer,
-                temperature integer,
-                humidity integer,
-                count integer default 1,
-                UNIQUE(time, identifier)
-            )"""
-        )
-
-        self.dbc.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                id integer primary key,
-                key text NOT NULL UNIQUE,
-                value text
-            )"""
-        )
-
+        # Only has an effect for new databases, an existing database needs a
+        # VACUUM once to switch to incremental auto vacuum
+        self.dbc.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.dbc.execute('PRAGMA auto_vacuum')
+        if self.dbc.fetchone()[0] != 2 and len(self.retention_tables) > 0:
+            log.warning('Database does not use incremental auto vacuum, run VACUUM once to give pruned pages back to the file system')
+
+        # WAL lets the reader threads query the database while we write.
+        # synchronous = NORMAL only syncs the WAL on checkpoints, which is
+        # still safe against corruption in WAL mode.
+        self.dbc.execute('PRAGMA journal_mode = WAL')
+        self.dbc.execute('PRAGMA synchronous = NORMAL')
+
+        create_tables(self.dbc)
         self.db.commit()
 
-    def __init__(self, gui, packaged, save_to_google_spreadsheet=None):
+    def __init__(self, gui, packaged, save_to_google_spreadsheet=None, ingest_batch_size=30, ingest_batch_time=5000, retention_raw=None, retention_minute=None, read_threads=2, backend=BACKEND_SQLITE, rollup_mirror=True, ingest_queue_size=1000, ingest_policy=None, db_path=None, forward=None, pyramid=None):
         self.gui = gui
         self.packaged = packaged
+        self.db_path = db_path # default: ~/.weather_station.db or next to this file
+        self.forward = forward # e.g. a value_db_server.Forwarder, gets a copy of every sample
+        self.ingest_batch_size = ingest_batch_size # samples per commit
+        self.ingest_batch_time = ingest_batch_time # max. ms a sample stays uncommitted
+        self.ingest_pending = 0
+        self.ingest_first_time = 0
+        self.ingest_oldest = None # monotonic arrival time of the oldest uncommitted sample
+        self.queue_latency = LatencyStats()
+        self.ingest_policy = ingest_policy or {} # table -> QUEUE_*, QUEUE_BLOCK if not given
+        self.commit_latency = LatencyStats()
+        self.backend = backend
+        self.store = None # ColumnStore with the columnar backend, created by the DB thread
+        self.rollup_mirror = rollup_mirror
+        self.mirror = None # ColumnStore with the closed hour/day buckets (sqlite backend)
+        self.mirror_rows = collections.OrderedDict()
+        self.mirror_last = {}
+        self.rollup_buckets = {}
+        self.rollup_rows = collections.OrderedDict()
+        self.rollup_open = {}
+        self.rollup_last = {} # newest bucket time in the column files per series (columnar backend)
+        self.rollup_recent = collections.OrderedDict() # (series, bucket time) -> written RollupBucket (columnar backend)
+        self.rollup_checkpoint_next = time.time() + ROLLUP_CHECKPOINT_INTERVAL
+        self.ingest_rows = dict((table, []) for table in TABLES)
+        self.graph_cache = {}
+        self.graph_cache_series = {} # (table, identifier) -> {key: entry} of graph_cache
+        self.graph_cache_lock = threading.Lock()
+        self.graph_cache_pending = []
+        self.pyramid = set(pyramid or []) # time resolutions of the graph pyramid, e.g. screens.TIME_SECONDS
+        self.pyramid_pending = set() # pyramid entries queued for the reader threads
+        self.rain_windows = {} # (identifier, rain_period) -> RainWindow
+        self.commit_lock = threading.Lock()
+        self.commit_generation = 0
+        self.settings = {}
+        self.settings_dirty = set()
+        self.settings_write_time = 0
+
+        # Horizons in seconds after which raw and minute rows are deleted
+        # (None keeps them forever). Raw rows are only read by graphs with a
+        # resolution below one minute and by the rain period (one hour),
+        # minute rows only below one hour.
+        self.retention_tables = []
+        if retention_raw != None:
+            for table in TABLES:
+                self.retention_tables.append((table, '', retention_raw))
+        if retention_minute != None:
+            for table in TABLES:
+                self.retention_tables.append((table, '_minute', retention_minute))
+        self.retention_index = 0
+        self.retention_next = time.time() + RETENTION_BATCH_INTERVAL
         self.gs_save_to_google_spreadsheet = save_to_google_spreadsheet
         if save_to_google_spreadsheet is not None:
             import gspread
@@ -952,9 +1837,11 @@ class ValueDB:
             self.gs_scope = ['https://spreadsheets.google.com/feeds','https://www.googleapis.com/auth/drive']
             self.gs_creds = ServiceAccountCredentials.from_json_keyfile_name('./files/iper-247520.json', self.gs_scope)
             self.gs_client = gspread.authorize(self.gs_creds)
-        self.run = True
-        self.func_queue = queue.Queue()
-        self.func_queue_ret = queue.Queue()
+        self.func_queue = IngestQueue(ingest_queue_size)
+        self.read_queue = queue.Queue()
+        self.read_local = threading.local()
+        self.read_threads = []
+        self.read_thread_count = read_threads
         self.init_handshake = threading.Semaphore(value=0)
         self.thread = threading.Thread(target=self.loop)
         self.thread.daemon = True
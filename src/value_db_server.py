@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+value_db_server.py: Central ValueDB for several weather stations
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+# The protocol is one JSON object per line in both directions. Every
+# request has an id that is sent back with its response, requests of one
+# connection are handled concurrently:
+#
+#   {"id": 1, "station": "kitchen", "op": "add_data", "table": "co2", "identifier": null,
+#    "samples": [[1546300800.25, [400, 2100, 4500]], ...]}
+#   {"id": 2, "station": "kitchen", "op": "get_data", "table": "co2", "field": "co2_concentration",
+#    "num": 60, "time_resolution": 60, "agg": "max"}
+#   {"id": 1, "result": 20}
+#   {"id": 2, "error": "..."}
+#
+# Every station gets its own database file in the data directory, so the
+# rows of a station are tagged by the file they are stored in.
+
+import os
+import re
+import sys
+import json
+import math
+import socket
+import asyncio
+import argparse
+import threading
+import collections
+import logging as log
+
+from value_db import ValueDB, TABLES, AGG_AVG, check_get_data
+from async_value_db import AsyncValueDB
+
+DEFAULT_PORT = 4290
+
+STATION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Longest request line, a batch of samples is sent as one line
+MAX_LINE_LENGTH = 16*1024*1024
+
+OPS = ['add_data', 'get_data', 'get_data_rain_period', 'stations']
+
+# Upper bounds for the slots of a get_data request and for the seconds of
+# a slot or a rain period
+MAX_NUM             = 10000
+MAX_TIME_RESOLUTION = 60*60*24*365
+
+# Forwarder: seconds between batches, samples kept while the server is
+# not reachable and seconds to wait for a response
+FORWARD_INTERVAL    = 10
+FORWARD_BUFFER_SIZE = 10000
+FORWARD_TIMEOUT     = 30
+
+class ValueDBServer:
+    def __init__(self, data_dir, **kwargs):
+        self.data_dir = data_dir
+        self.kwargs   = kwargs # passed on to every ValueDB
+        self.dbs      = {}
+        self.dbs_lock = threading.Lock()
+
+    def db(self, station):
+        # Opening a database blocks, call this from an executor
+        if not isinstance(station, str) or not STATION_ID.match(station):
+            raise ValueError('Invalid station id: {0}'.format(station))
+
+        with self.dbs_lock:
+            vdb = self.dbs.get(station)
+            if vdb == None:
+                db_path = os.path.join(self.data_dir, 'station_{0}.db'.format(station))
+                vdb = AsyncValueDB(ValueDB(True, False, db_path=db_path, **self.kwargs))
+                self.dbs[station] = vdb
+
+        return vdb
+
+    def stop(self):
+        with self.dbs_lock:
+            for vdb in self.dbs.values():
+                vdb.vdb.stop()
+            self.dbs = {}
+
+    def number(self, value):
+        return isinstance(value, (int, float)) and math.isfinite(value)
+
+    def positive(self, request, key, maximum):
+        value = request.get(key)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1 or value > maximum:
+            raise ValueError('Invalid {0}: {1}'.format(key, value))
+        return value
+
+    async def dispatch(self, request):
+        # Everything is checked before the database of the station is
+        # opened, a bad request must not create a database or fail half way
+        loop = asyncio.get_event_loop()
+        op = request.get('op')
+
+        if op not in OPS:
+            raise ValueError('Unknown op: {0}'.format(op))
+
+        if op == 'stations':
+            with self.dbs_lock:
+                return sorted(self.dbs)
+
+        table = request.get('table')
+        if table not in TABLES:
+            raise ValueError('Unknown table: {0}'.format(table))
+
+        station = request.get('station')
+        identifier = request.get('identifier')
+
+        if TABLES[table].identifier:
+            if isinstance(identifier, bool) or not isinstance(identifier, int):
+                raise ValueError('Table {0} needs an integer identifier: {1}'.format(table, identifier))
+        elif identifier != None:
+            raise ValueError('Table {0} has no identifier: {1}'.format(table, identifier))
+
+        if op == 'add_data':
+            samples = request.get('samples', [])
+            if not isinstance(samples, list):
+                raise ValueError('Invalid samples for {0}: {1}'.format(table, samples))
+
+            for sample in samples:
+                if not isinstance(sample, list) or len(sample) != 2 or isinstance(sample[0], bool) or not self.number(sample[0]) or \
+                   not isinstance(sample[1], list) or len(sample[1]) != len(TABLES[table].columns) or \
+                   not all(self.number(value) for value in sample[1]):
+                    raise ValueError('Invalid sample for {0}: {1}'.format(table, sample))
+        elif op == 'get_data':
+            num = self.positive(request, 'num', MAX_NUM)
+            time_resolution = self.positive(request, 'time_resolution', MAX_TIME_RESOLUTION)
+            field = request.get('field')
+            is_rain = request.get('is_rain', False)
+            agg = request.get('agg', AGG_AVG)
+            if not isinstance(is_rain, bool):
+                raise ValueError('Invalid is_rain: {0}'.format(is_rain))
+            check_get_data(table, field, is_rain, agg)
+        elif op == 'get_data_rain_period':
+            if table != 'station':
+                raise ValueError('Only the station table has a rain period: {0}'.format(table))
+            rain_period = self.positive(request, 'rain_period', MAX_TIME_RESOLUTION)
+
+        vdb = await loop.run_in_executor(None, self.db, station)
+
+        if op == 'add_data':
+            for timestamp, values in samples:
+                await vdb.add_data(table, identifier, tuple(values), timestamp)
+            return len(samples)
+        elif op == 'get_data':
+            return await vdb.get_data(num, time_resolution, field, table, identifier, is_rain, agg)
+
+        return await vdb.get_data_rain_period(identifier, rain_period)
+
+    async def handle_request(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line.decode('utf-8'))
+            request_id = request.get('id')
+            response = {'id': request_id, 'result': await self.dispatch(request)}
+        except Exception as e:
+            response = {'id': request_id, 'error': str(e)}
+
+        if not writer.is_closing():
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        log.info('Connection from {0}'.format(peer))
+
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self.handle_request(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            # answer what was already sent before closing
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+        except (ConnectionError, ValueError) as e:
+            log.warning('Connection from {0} failed: {1}'.format(peer, e))
+        finally:
+            writer.close()
+
+        log.info('Connection from {0} closed'.format(peer))
+
+    async def serve(self, host = None, port = DEFAULT_PORT, unix_path = None):
+        if unix_path != None:
+            server = await asyncio.start_unix_server(self.handle_client, unix_path, limit=MAX_LINE_LENGTH)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port, limit=MAX_LINE_LENGTH)
+
+        log.info('Listening on {0}'.format(unix_path if unix_path != None else '{0}:{1}'.format(host or '*', port)))
+
+        async with server:
+            await server.serve_forever()
+
+class Forwarder:
+    # Sends a copy of the samples of a station to a ValueDBServer, in batches
+    # from its own thread, so the callbacks never wait for the network.
+    # address is (host, port) or the path of a unix socket.
+    def __init__(self, address, station, interval = FORWARD_INTERVAL, buffer_size = FORWARD_BUFFER_SIZE):
+        if not STATION_ID.match(station):
+            raise ValueError('Invalid station id: {0}'.format(station))
+
+        self.address    = address
+        self.station    = station
+        self.interval   = interval
+        self.samples    = collections.deque(maxlen=buffer_size) # oldest samples are dropped first
+        self.condition  = threading.Condition()
+        self.run        = True
+        self.sock       = None
+        self.sock_file  = None
+        self.request_id = 0
+
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, table, identifier, values, timestamp):
+        with self.condition:
+            self.samples.append((table, identifier, list(values), timestamp))
+
+    def stop(self):
+        with self.condition:
+            self.run = False
+            self.condition.notify_all()
+
+        self.thread.join(FORWARD_TIMEOUT)
+
+    def loop(self):
+        while True:
+            with self.condition:
+                if self.run:
+                    self.condition.wait(self.interval)
+                run = self.run
+                batch = list(self.samples)
+                self.samples.clear()
+
+            if len(batch) > 0:
+                try:
+                    self.send(batch)
+                except (OSError, ValueError) as e:
+                    log.warning('Could not forward {0} samples to {1}: {2}'.format(len(batch), self.address, e))
+                    self.disconnect()
+
+                    # keep them for the next try, newer samples come after them
+                    with self.condition:
+                        room = self.samples.maxlen - len(self.samples)
+                        if room > 0:
+                            self.samples.extendleft(reversed(batch[-room:]))
+
+            if not run:
+                break
+
+        self.disconnect()
+
+    def connect(self):
+        if isinstance(self.address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(FORWARD_TIMEOUT)
+            self.sock.connect(self.address)
+        else:
+            self.sock = socket.create_connection(self.address, FORWARD_TIMEOUT)
+
+        self.sock_file = self.sock.makefile('rb')
+
+    def disconnect(self):
+        if self.sock != None:
+            try:
+                self.sock_file.close()
+                self.sock.close()
+            except OSError:
+                pass
+
+        self.sock = None
+        self.sock_file = None
+
+    def send(self, batch):
+        if self.sock == None:
+            self.connect()
+
+        # one add_data request per table and sensor
+        groups = collections.OrderedDict()
+        for table, identifier, values, timestamp in batch:
+            groups.setdefault((table, identifier), []).append([timestamp, values])
+
+        request_ids = set()
+        lines = []
+        for (table, identifier), samples in groups.items():
+            self.request_id += 1
+            request_ids.add(self.request_id)
+            lines.append(json.dumps({'id': self.request_id, 'station': self.station, 'op': 'add_data',
+                                     'table': table, 'identifier': identifier, 'samples': samples}))
+
+        self.sock.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+
+        while len(request_ids) > 0:
+            line = self.sock_file.readline()
+            if not line:
+                raise ValueError('Connection closed by server')
+
+            response = json.loads(line.decode('utf-8'))
+            request_ids.discard(response.get('id'))
+            if 'error' in response:
+                # the server won't take these samples on a retry either
+                log.error('Server rejected samples: {0}'.format(response['error']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Central database for several weather stations')
+    parser.add_argument('--data-dir', default=os.path.join(os.path.expanduser('~'), 'weather_stations'), help='directory for the station databases (default: %(default)s)')
+    parser.add_argument('--host', help='address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port (default: %(default)s)')
+    parser.add_argument('--unix', help='listen on this unix socket instead of TCP')
+    parser.add_argument('--retention-raw', type=int, help='seconds to keep raw samples')
+    parser.add_argument('--retention-minute', type=int, help='seconds to keep minute rollups')
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+
+    if not os.path.isdir(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    server = ValueDBServer(args.data_dir, retention_raw=args.retention_raw, retention_minute=args.retention_minute)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+value_db_tool.py: Import and export of the sensor tables of the database
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+# Stop the weather station before importing, it keeps the open rollup
+# buckets in memory and would overwrite the rebuilt ones.
+#
+#   value_db_tool.py export co2_hour -o co2_hour.csv
+#   value_db_tool.py import station station.jsonl --format jsonl
+#   value_db_tool.py check all
+#   value_db_tool.py rebuild station
+
+import sys
+import os
+import csv
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import itertools
+import logging as log
+
+from value_db import TABLES, ROLLUP_RESOLUTIONS, create_tables
+
+# Rows per executemany and rows per transaction of an import
+IMPORT_CHUNK_SIZE  = 5000
+IMPORT_COMMIT_ROWS = 100000
+
+def default_db_path():
+    return os.path.join(os.path.expanduser('~'), '.weather_station.db')
+
+def split_table(name):
+    # 'station_hour' -> (schema of station, '_hour')
+    if name in TABLES:
+        return TABLES[name], ''
+
+    for suffix, seconds in ROLLUP_RESOLUTIONS:
+        if name.endswith(suffix) and name[:-len(suffix)] in TABLES:
+            return TABLES[name[:-len(suffix)]], suffix
+
+    raise ValueError('Unknown table: {0}'.format(name))
+
+def table_columns(schema, suffix):
+    columns = ['time']
+    if schema.identifier:
+        columns.append('identifier')
+    if suffix == '':
+        return columns + schema.columns
+    return columns + schema.rollup_columns + ['count']
+
+def parse_value(value):
+    # CSV gives us strings, empty fields are stored as NULL
+    if value == None or value == '':
+        return None
+    if isinstance(value, str):
+        value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def read_rows(f, fmt, columns):
+    if fmt == 'csv':
+        records = csv.DictReader(f)
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+
+    for record in records:
+        yield [parse_value(record.get(column)) for column in columns]
+
+def export_table(db, name, f, fmt, start = None, end = None):
+    schema, suffix = split_table(name)
+    columns = table_columns(schema, suffix)
+
+    query = 'SELECT {0} FROM {1} WHERE time >= ? AND time < ? ORDER BY time, id'.format(', '.join(columns), name)
+    args = (start if start != None else -sys.maxsize, end if end != None else sys.maxsize)
+
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(columns)
+
+    count = 0
+    # the cursor streams the rows, the table is never loaded as a whole
+    for row in db.execute(query, args):
+        if fmt == 'csv':
+            writer.writerow(['' if value == None else value for value in row])
+        else:
+            f.write(json.dumps(dict(zip(columns, row))) + '\n')
+        count += 1
+
+    return count
+
+def import_table(db, name, f, fmt):
+    schema, suffix = split_table(name)
+    if suffix != '':
+        raise ValueError('Only raw tables can be imported, the rollups are rebuilt from them')
+
+    columns = table_columns(schema, suffix)
+    rows = read_rows(f, fmt, columns)
+
+    count = 0
+    uncommitted = 0
+    first = None
+    last = None
+    while True:
+        chunk = list(itertools.islice(rows, IMPORT_CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+
+        for row in chunk:
+            if row[0] == None:
+                raise ValueError('Row without time: {0}'.format(row))
+
+        db.executemany(schema.insert_sql, chunk)
+
+        times = [row[0] for row in chunk]
+        first = min(times) if first == None else min(first, min(times))
+        last = max(times) if last == None else max(last, max(times))
+
+        count += len(chunk)
+        uncommitted += len(chunk)
+        if uncommitted >= IMPORT_COMMIT_ROWS:
+            db.commit()
+            uncommitted = 0
+            log.info('Imported {0} rows'.format(count))
+
+    if count > 0:
+        rebuild_rollups(db, schema, first, last)
+
+    db.commit()
+    return count
+
+def covered_start(db, schema, suffix, seconds, first):
+    # First bucket of a resolution that is fully covered by the raw rows
+    # from first on. After retention the bucket with the oldest raw rows has
+    # lost some of its rows, it is skipped if its rollup counts more samples
+    # (of any sensor) than the raw table still has for it.
+    start = int(first) - int(first) % seconds
+    raw_sql, rollup_sql = schema.rollup_check_sql(suffix, seconds)
+
+    raw = dict(((row[0], row[1]), row[2]) for row in db.execute(raw_sql, (start, start + seconds)))
+    for bucket_time, identifier, count in db.execute(rollup_sql, (start, start + seconds)):
+        if count > raw.get((bucket_time, identifier), 0):
+            return start + seconds
+
+    return start
+
+def rebuild_rollups(db, schema, first, last):
+    # Recompute all buckets that contain imported rows from the raw table,
+    # one GROUP BY per resolution instead of one update per row
+    for suffix, seconds in ROLLUP_RESOLUTIONS:
+        start = covered_start(db, schema, suffix, seconds, first)
+        end = int(last) - int(last) % seconds + seconds
+        if start >= end:
+            continue
+
+        delete_sql, insert_sql = schema.rollup_rebuild_sql(suffix, seconds)
+        db.execute(delete_sql, (start, end))
+        db.execute(insert_sql, (start, end))
+
+def raw_range(db, schema, start = None, end = None):
+    # Time range of the raw rows, clipped to start/end
+    first, last = db.execute('SELECT MIN(time), MAX(time) FROM {0}'.format(schema.name)).fetchone()
+    if first == None:
+        return None, None
+
+    if start != None:
+        first = max(first, start)
+    if end != None:
+        last = min(last, end - 1)
+    if first > last:
+        return None, None
+
+    return first, last
+
+def rebuild_table(db, schema, start = None, end = None):
+    # Buckets that are only partially covered by the raw table (because of
+    # retention) must not be rebuilt from the remaining rows, so don't
+    # rebuild the range before the raw horizon (see covered_start)
+    first, last = raw_range(db, schema, start, end)
+    if first == None:
+        return False
+
+    rebuild_rollups(db, schema, first, last)
+    db.commit()
+    return True
+
+def check_table(db, schema, start = None, end = None, examples = 5):
+    # Compares the number of samples per bucket in the raw and the rollup
+    # tables by merging two sorted streams, returns {suffix: mismatches}
+    first, last = raw_range(db, schema, start, end)
+    ret = {}
+    if first == None:
+        return ret
+
+    for suffix, seconds in ROLLUP_RESOLUTIONS:
+        bucket_start = covered_start(db, schema, suffix, seconds, first)
+        bucket_end = int(last) - int(last) % seconds + seconds
+        raw_sql, rollup_sql = schema.rollup_check_sql(suffix, seconds)
+
+        raw = db.cursor().execute(raw_sql, (bucket_start, bucket_end))
+        rollup = db.cursor().execute(rollup_sql, (bucket_start, bucket_end))
+
+        mismatches = 0
+        raw_row = next(raw, None)
+        rollup_row = next(rollup, None)
+        while raw_row != None or rollup_row != None:
+            raw_key = None if raw_row == None else (raw_row[0], raw_row[1] if raw_row[1] != None else -1)
+            rollup_key = None if rollup_row == None else (rollup_row[0], rollup_row[1] if rollup_row[1] != None else -1)
+
+            if rollup_key == None or (raw_key != None and raw_key < rollup_key):
+                problem = (raw_row[0], raw_row[1], raw_row[2], 0)
+                raw_row = next(raw, None)
+            elif raw_key == None or rollup_key < raw_key:
+                problem = (rollup_row[0], rollup_row[1], 0, rollup_row[2])
+                rollup_row = next(rollup, None)
+            else:
+                problem = None
+                if raw_row[2] != rollup_row[2]:
+                    problem = (raw_row[0], raw_row[1], raw_row[2], rollup_row[2])
+                raw_row = next(raw, None)
+                rollup_row = next(rollup, None)
+
+            if problem != None:
+                if mismatches < examples:
+                    bucket_time, identifier, raw_count, rollup_count = problem
+                    log.info('{0}{1}: bucket {2}{3} has {4} raw samples, rollup counts {5}'.format(
+                        schema.name, suffix, bucket_time, '' if identifier == None else ' identifier {0}'.format(identifier), raw_count, rollup_count))
+                mismatches += 1
+
+        ret[suffix] = mismatches
+
+    return ret
+
+def drop_rollup_mirror(db_path):
+    # The hour/day mirror of ValueDB only appends new buckets, it is
+    # rebuilt from the database on the next start
+    mirror_path = os.path.splitext(db_path)[0] + '.rollups'
+    if os.path.isdir(mirror_path):
+        shutil.rmtree(mirror_path)
+
+def parse_time(value):
+    # unix time or YYYY-MM-DD
+    try:
+        return int(value)
+    except ValueError:
+        return int(time.mktime(time.strptime(value, '%Y-%m-%d')))
+
+def main():
+    parser = argparse.ArgumentParser(description='Import and export weather station data')
+    parser.add_argument('--db', default=default_db_path(), help='database file (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export', help='write a table as CSV or JSON lines')
+    export_parser.add_argument('table', help='e.g. co2, station or station_hour')
+    export_parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    export_parser.add_argument('--start', type=parse_time, help='first time (unix time or YYYY-MM-DD)')
+    export_parser.add_argument('--end', type=parse_time, help='end time, exclusive')
+
+    import_parser = subparsers.add_parser('import', help='append CSV or JSON lines to a raw table and rebuild its rollups')
+    import_parser.add_argument('table', help='e.g. co2 or station')
+    import_parser.add_argument('input', help='input file (- for stdin)')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+
+    for name, help_text in (('rebuild', 'recompute the rollups of a table from its raw rows'),
+                            ('check', 'compare the number of samples per bucket in raw and rollup tables')):
+        table_parser = subparsers.add_parser(name, help=help_text)
+        table_parser.add_argument('table', help='raw table, e.g. co2, or all')
+        table_parser.add_argument('--start', type=parse_time, help='first time (unix time or YYYY-MM-DD)')
+        table_parser.add_argument('--end', type=parse_time, help='end time, exclusive')
+
+    args = parser.parse_args()
+    if args.command == None:
+        parser.print_help()
+        return 1
+
+    log.basicConfig(level=log.INFO, format='%(message)s')
+
+    db = sqlite3.connect(args.db, timeout=30)
+    try:
+        if args.command == 'export':
+            if args.output == None:
+                count = export_table(db, args.table, sys.stdout, args.format, args.start, args.end)
+            else:
+                with open(args.output, 'w', newline='') as f:
+                    count = export_table(db, args.table, f, args.format, args.start, args.end)
+            log.info('Exported {0} rows'.format(count))
+        elif args.command == 'import':
+            # same as ValueDB for a new database, only works before the first table
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            create_tables(db.cursor())
+            if args.input == '-':
+                count = import_table(db, args.table, sys.stdin, args.format)
+            else:
+                with open(args.input, newline='') as f:
+                    count = import_table(db, args.table, f, args.format)
+            drop_rollup_mirror(args.db)
+            log.info('Imported {0} rows, rollups rebuilt'.format(count))
+        elif args.command in ('rebuild', 'check'):
+            if args.table == 'all':
+                schemas = list(TABLES.values())
+            else:
+                schema, suffix = split_table(args.table)
+                if suffix != '':
+                    raise ValueError('Use the raw table, e.g. {0}'.format(schema.name))
+                schemas = [schema]
+
+            if args.command == 'rebuild':
+                for schema in schemas:
+                    if rebuild_table(db, schema, args.start, args.end):
+                        log.info('Rebuilt rollups of {0}'.format(schema.name))
+                drop_rollup_mirror(args.db)
+            else:
+                ok = True
+                for schema in schemas:
+                    for suffix, mismatches in check_table(db, schema, args.start, args.end).items():
+                        log.info('{0}{1}: {2}'.format(schema.name, suffix, 'ok' if mismatches == 0 else '{0} buckets differ'.format(mismatches)))
+                        ok = ok and mismatches == 0
+                if not ok:
+                    return 1
+    except ValueError as e:
+        log.error(str(e))
+        return 1
+    finally:
+        db.close()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+test_backfill.py: Out of order samples give the same graphs with every backend
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import column_store
+from value_db import ValueDB, BACKEND_SQLITE, BACKEND_COLUMNAR, AGG_AVG, AGG_MIN, AGG_MAX, AGG_P95
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def fill(self, backend, samples):
+        db_path = os.path.join(self.path, backend, 'weather_station.db')
+        os.makedirs(os.path.dirname(db_path))
+
+        # small batches, so the samples are spread over many commits
+        vdb = ValueDB(True, False, backend=backend, db_path=db_path, rollup_mirror=False, ingest_batch_size=5, ingest_queue_size=0)
+        for timestamp, values in samples:
+            vdb.add_data('co2', None, values, timestamp)
+        vdb.stop()
+
+        return ValueDB(True, False, backend=backend, db_path=db_path, rollup_mirror=False)
+
+    def test_shuffled_samples(self):
+        rng = random.Random(1)
+        now = time.time()
+        samples = [(now - 2*24*60*60 + i*97.3, (rng.randint(300, 900), rng.randint(-100, 300), rng.randint(0, 1000))) for i in range(600)]
+        rng.shuffle(samples)
+
+        sqlite = self.fill(BACKEND_SQLITE, samples)
+        columnar = self.fill(BACKEND_COLUMNAR, samples)
+        try:
+            # the P95 of a rollup is estimated and depends on how often a
+            # bucket was reopened, only the raw P95 is exact
+            for time_resolution, aggs in [(30, [AGG_AVG, AGG_MIN, AGG_MAX, AGG_P95]), (600, [AGG_AVG, AGG_MIN, AGG_MAX]),
+                                          (60*60, [AGG_AVG, AGG_MIN, AGG_MAX]), (24*60*60, [AGG_AVG, AGG_MIN, AGG_MAX])]:
+                for agg in aggs:
+                    expected = sqlite.get_data(60, time_resolution, 'co2_concentration', 'co2', agg=agg)
+                    values = columnar.get_data(60, time_resolution, 'co2_concentration', 'co2', agg=agg)
+                    self.assertEqual([None if value == None else round(value, 6) for value in values],
+                                     [None if value == None else round(value, 6) for value in expected], (time_resolution, agg))
+
+            # backfill must not leave more runs per segment than are merged
+            for series_path, _, _ in os.walk(columnar.store.path):
+                runs = {}
+                for segment, run in columnar.store.segments(series_path):
+                    runs[segment] = runs.get(segment, 0) + 1
+                for segment, count in runs.items():
+                    self.assertLessEqual(count, column_store.COMPACT_RUNS + 1, series_path)
+        finally:
+            sqlite.stop()
+            columnar.stop()
+
+if __name__ == '__main__':
+    unittest.main()
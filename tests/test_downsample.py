@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tabletop Weather Station
+
+test_downsample.py: Spikes are kept by the peak graph, noise is not
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public
+License along with this program; if not, write to the
+Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+Boston, MA 02111-1307, USA.
+"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from downsample import lttb, SPIKE_COLUMNS
+
+class LttbTest(unittest.TestCase):
+    def spike(self, width, value, start = 5, num = 20):
+        # flat data around 50 with a spike of width columns, the average of
+        # a spike column is raised as well
+        averages = [50]*num
+        minimums = [45]*num
+        maximums = [55]*num
+        for i in range(start, start + width):
+            if value > 50:
+                averages[i] = 80
+                maximums[i] = value
+            else:
+                averages[i] = 20
+                minimums[i] = value
+
+        return averages, minimums, maximums
+
+    def test_spikes(self):
+        for width in range(1, SPIKE_COLUMNS + 1):
+            for value in (150, -50):
+                expected = [50]*20
+                expected[5:5 + width] = [value]*width
+                self.assertEqual(lttb(*self.spike(width, value)), expected, (width, value))
+
+    def test_flat_noise(self):
+        rng = random.Random(1)
+        averages = [50 + rng.uniform(-1, 1) for i in range(100)]
+        minimums = [average - rng.uniform(4, 6) for average in averages]
+        maximums = [average + rng.uniform(4, 6) for average in averages]
+        self.assertEqual(lttb(averages, minimums, maximums), averages)
+
+    def test_empty_columns(self):
+        self.assertEqual(lttb([None, 50, None], [None, 45, None], [None, 55, None]), [None, 50, None])
+        self.assertEqual(lttb([], [], []), [])
+
+if __name__ == '__main__':
+    unittest.main()